@@ -1,79 +1,113 @@
+import argparse
 import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 import numpy as np
 import pandas as pd
 
 import midi_helper as helper
-from markov import Markov
+from database import Database
+from markov import Markov, MarkovModel, NgramCounter
 from scipy.stats import chi2_contingency
 from scipy.stats import chi2
 
+PROBABILITY = 0.95
 
-def chi(filename, order):
-    # Extract the notes from midi file using midi helper
-    midi_extraction = helper.ExtractMidi(f"midi/{filename}")
 
-    midi_extraction.parse_midi()
+def chi(expected_notes, observed_notes):
+    # Token ids shared by both sequences so the counts line up column for column
+    tokens, inverse = np.unique(np.concatenate([expected_notes, observed_notes]), return_inverse=True)
+    expected = np.bincount(inverse[:len(expected_notes)], minlength=len(tokens))
+    observed = np.bincount(inverse[len(expected_notes):], minlength=len(tokens))
 
-    expected_notes = midi_extraction.get_notes()
-    length = len(expected_notes)
+    # Remove occurrences that do not occur in either set
+    present = (expected > 0) & (observed > 0)
+    table = [expected[present], observed[present]]
+    chi2_stat, p, dof, _ = chi2_contingency(table)
 
-    # Generate markov chain
-    markov_chain = Markov(order)
-    markov = markov_chain.transition_matrix(expected_notes)
-
-    # Generate a sequence of notes using the markov chain
-    observed_notes = markov_chain.generate_sequence(markov, length)
-
-    new_observed = []
-    new_expected = []
-
-    # Prepare the data by removing occurrences that do not occur in either set
-    for note in observed_notes:
-        if note in expected_notes:
-            new_observed.append(note)
-
-    for note in expected_notes:
-        if note in new_observed:
-            new_expected.append(note)
-
-    # Create contingency tables for expected and observed frequencies
-    unique_chord, expected = np.unique(new_expected, return_counts=True)
-    unique_notes, observed = np.unique(new_observed, return_counts=True)
-
-    table = [expected.tolist(), observed.tolist()]
-    chi2_stat, p, dof, expected = chi2_contingency(table)
-
-    prob = 0.95
     # Generate critical value
-    critical = chi2.ppf(prob, dof)
+    critical = chi2.ppf(PROBABILITY, dof)
 
-    return dof, critical, chi2_stat
+    return dof, critical, chi2_stat, p
 
 
-# Get a list of all files in the midi dir with the .mid extension and run the chi-squre test
-order = 1
-data = {"midi file": [], "degrees of freedom": [], "critical": [], "test statistic": [], "reject H0": []}
-files = [f for f in os.listdir('./midi') if f.endswith(".mid")]
-for file in files:
+def evaluate(midi_dir, filename, order, seeds, instrument, backend, backoff):
+    # Runs inside a worker process, one row per seed and failures are recorded instead of raised
+    rows = []
+    start = time.perf_counter()
     try:
-        dof, critical, chi2_stat = chi(file, order)
-        data['midi file'].append(file)
-        data["degrees of freedom"].append(dof)
-        data["critical"].append(round(critical, 3))
-        data["test statistic"].append(round(chi2_stat, 3))
-
-        if abs(chi2_stat) >= critical:
-            data["reject H0"].append(True)
+        # Token streams and fitted models come from music.db when this file has been seen before
+        database = Database()
+        midi_extraction = helper.ExtractMidi(os.path.join(midi_dir, filename), database, backend)
+        expected_notes = np.array([note for note, _ in midi_extraction.iter_tokens(instrument)])
+
+        # Only the notes are tested, so only the notes chain is loaded or fitted
+        markov_chain = Markov(order, backoff)
+        key = (filename, midi_extraction.get_backend(), midi_extraction.get_version(), instrument, order,
+               markov_chain.kinds[0], midi_extraction.get_hash())
+        stored = database.get_model(*key)
+        if stored is not None:
+            model = MarkovModel.loads(stored)
         else:
-            data["reject H0"].append(False)
-
-    except Exception:
-        pass
-
-# Convert data dictionary to dataframe
-df = pd.DataFrame(data)
-
-# Export to csv
-df.to_csv('chi_square.csv')
-
+            model = markov_chain.from_counter(NgramCounter(order).update(expected_notes.tolist()))
+            database.insert_or_update_model(*key, model.dumps())
+        setup = time.perf_counter() - start
+
+        for seed in seeds:
+            seed_start = time.perf_counter()
+            rng = np.random.default_rng(seed)
+            observed_notes = np.array(markov_chain.generate_batch(model, [len(expected_notes)], rng)[0])
+            dof, critical, chi2_stat, p = chi(expected_notes, observed_notes)
+            rows.append({"midi file": filename, "order": order, "seed": seed, "tokens": len(expected_notes),
+                         "degrees of freedom": dof, "critical": round(critical, 3),
+                         "test statistic": round(chi2_stat, 3), "p value": p,
+                         "reject H0": bool(abs(chi2_stat) >= critical),
+                         "seconds": round(setup + time.perf_counter() - seed_start, 3), "error": None})
+    except Exception as e:
+        done = {row["seed"] for row in rows}
+        rows += [{"midi file": filename, "order": order, "seed": seed, "seconds": round(time.perf_counter() - start, 3),
+                  "error": f"{type(e).__name__}: {e}"} for seed in seeds if seed not in done]
+    return rows
+
+
+def sweep(midi_dir, orders, seeds, workers, instrument, backend, backoff):
+    files = sorted(f for f in os.listdir(midi_dir) if f.endswith(".mid"))
+    rows = []
+    start = time.perf_counter()
+
+    # One task per file and order, so a model is fitted once and shared by every seed
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(evaluate, midi_dir, filename, order, seeds, instrument, backend, backoff):
+                   (filename, order) for filename in files for order in orders}
+        for count, future in enumerate(as_completed(futures), start=1):
+            filename, order = futures[future]
+            result = future.result()
+            rows += result
+            failed = sum(row["error"] is not None for row in result)
+            print(f"[{count}/{len(futures)}] {filename} order {order}: "
+                  f"{len(result) - failed} seeds tested, {failed} failed")
+
+    print(f"Finished {len(rows)} tests in {time.perf_counter() - start:.2f}s")
+    columns = ["midi file", "order", "seed", "tokens", "degrees of freedom", "critical", "test statistic", "p value",
+               "reject H0", "seconds", "error"]
+    return pd.DataFrame(rows, columns=columns).sort_values(["midi file", "order", "seed"], ignore_index=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Chi-square test of generated notes against every midi file")
+    parser.add_argument("--midi-dir", default="midi")
+    parser.add_argument("--orders", type=int, nargs="+", default=[1])
+    parser.add_argument("--seeds", type=int, default=1)
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--instrument", default="Piano")
+    parser.add_argument("--backend", choices=helper.ExtractMidi.BACKENDS, default="music21")
+    parser.add_argument("--backoff", action="store_true")
+    parser.add_argument("--output", default="chi_square.csv")
+    args = parser.parse_args()
+
+    df = sweep(args.midi_dir, args.orders, list(range(args.seeds)), args.workers, args.instrument, args.backend,
+               args.backoff)
+
+    # Export to csv
+    df.to_csv(args.output)
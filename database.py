@@ -1,27 +1,103 @@
 import json
+import os
 import sqlite3
+import threading
+from dataclasses import dataclass
 from sqlite3 import Error
 
+import numpy as np
+
+
+@dataclass()
+class SegmentRecord:
+    filename: str
+    index: int
+    instrument: str
+    length: int
+    order: int
+    key: str
+    notes: list
+    durations: np.ndarray
+
 
 class Database:
+    # Connections are shared by every Database in the same thread and process
+    _local = threading.local()
+    _initialised = set()
+    _lock = threading.Lock()
+
     def __init__(self, path="music.db"):
         self.path = path
-        table = """CREATE TABLE IF NOT EXISTS Sequence (
-                                            filename TEXT PRIMARY KEY,
-                                            sequences JSON,
+        extraction_table = """CREATE TABLE IF NOT EXISTS Extraction (
+                                            hash TEXT,
+                                            backend TEXT,
+                                            version INTEGER,
+                                            instruments JSON,
+                                            notes JSON,
                                             durations JSON,
-                                            key TEXT
+                                            key TEXT,
+                                            PRIMARY KEY (hash, backend, version)
+                                        );"""
+        vocabulary_table = """CREATE TABLE IF NOT EXISTS Vocabulary (
+                                            id INTEGER PRIMARY KEY,
+                                            token TEXT UNIQUE
                                         );"""
+        segment_table = """CREATE TABLE IF NOT EXISTS Segment (
+                                            filename TEXT,
+                                            idx INTEGER,
+                                            instrument TEXT,
+                                            length INTEGER,
+                                            markov_order INTEGER,
+                                            key TEXT,
+                                            notes BLOB,
+                                            durations BLOB,
+                                            PRIMARY KEY (filename, idx)
+                                        );"""
+        model_table = """CREATE TABLE IF NOT EXISTS Model (
+                                            filename TEXT,
+                                            backend TEXT,
+                                            version INTEGER,
+                                            instrument TEXT,
+                                            markov_order INTEGER,
+                                            kind TEXT,
+                                            hash TEXT,
+                                            model BLOB,
+                                            PRIMARY KEY (filename, backend, version, instrument, markov_order, kind)
+                                        );"""
+        segment_indexes = ["CREATE INDEX IF NOT EXISTS segment_key ON Segment (key, length);",
+                           "CREATE INDEX IF NOT EXISTS segment_length ON Segment (length);"]
 
-        # Create a database connection
-        self.conn = self.create_connection()
+        # Token for every vocabulary id and the reverse lookup, loaded on demand
+        self._tokens = np.empty(0, dtype=object)
+        self._token_ids = {}
 
-        # Create database table
+        # Create database tables, once per database file
         if self.conn is not None:
-            self.create_table(table)
+            with Database._lock:
+                if self.path not in Database._initialised:
+                    self.create_table(extraction_table)
+                    self.create_table(vocabulary_table)
+                    self.create_table(segment_table)
+                    self.create_table(model_table)
+                    for index in segment_indexes:
+                        self.create_table(index)
+                    self.__migrate_sequences()
+                    Database._initialised.add(self.path)
         else:
             print("Error! cannot create the database connection.")
 
+    @property
+    def conn(self):
+        connections = getattr(Database._local, "connections", None)
+        if connections is None:
+            connections = Database._local.connections = {}
+
+        # Key by process too so forked workers never reuse their parent's connection
+        key = (os.getpid(), self.path)
+        if connections.get(key) is None:
+            connections[key] = self.create_connection()
+        return connections[key]
+
     def create_table(self, table):
         try:
             c = self.conn.cursor()
@@ -30,10 +106,27 @@ class Database:
         except Error as e:
             print(e)
 
+    def __migrate_sequences(self):
+        # Older databases hold every file's segments as JSON in one Sequence row, split them into Segment rows once
+        if not self._fetch("SELECT 1 FROM sqlite_master WHERE type='table' AND name='Sequence'"):
+            return
+        rows = self._fetch("SELECT filename, sequences, durations, key FROM Sequence "
+                           "WHERE filename NOT IN (SELECT filename FROM Segment)")
+        self.insert_many_segments([(filename, self.to_lst(sequences), self.to_lst(durations), key, None, None)
+                                   for filename, sequences, durations, key in rows])
+
+        # Only drop the legacy rows once every file made it across
+        missing = self._fetch("SELECT COUNT(*) FROM Sequence WHERE filename NOT IN (SELECT filename FROM Segment)")
+        if missing[0][0] == 0:
+            self.create_table("DROP TABLE Sequence")
+
     def create_connection(self):
         conn = None
         try:
-            conn = sqlite3.connect(self.path)
+            conn = sqlite3.connect(self.path, timeout=30)
+            # Readers no longer block the writer and commits skip most fsyncs
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
         except Error as e:
             print(e)
 
@@ -57,38 +150,136 @@ class Database:
         cur.close()
         return rows
 
-    def insert_or_update(self, filename, sequences, durations, key):
-        data = self._fetch(
-            "SELECT filename FROM Sequence WHERE filename=?", (filename,))
+    def insert_segments(self, filename, sequences, durations, key, instrument=None, order=None):
+        self.insert_many_segments([(filename, sequences, durations, key, instrument, order)])
 
-        if len(data) == 0:
-            params = [filename, sequences, durations, key]
-            try:
-                insert_query = "INSERT INTO Sequence (filename, sequences, durations, key) VALUES(?,?,?,?)"
-                self._insert(insert_query, params)
-            except Error as e:
-                print(e)
-        else:
-            update_params = [sequences, durations, key, filename]
+    def insert_many_segments(self, files):
+        # files holds (filename, sequences, durations, key, instrument, order) for each file
+        ids = self.token_ids([token for file in files for sequence in file[1] for token in sequence])
+        rows = []
+        pos = 0
+        for filename, sequences, durations, key, instrument, order in files:
+            # One row per segment, token ids and durations stored as packed arrays rather than JSON text
+            for i in range(len(sequences)):
+                end = pos + len(sequences[i])
+                rows.append((filename, i, instrument, len(sequences[i]), order, key, ids[pos:end].tobytes(),
+                             np.asarray(durations[i], dtype=np.float64).tobytes()))
+                pos = end
+
+        try:
+            # Replace the segments of every file in a single transaction
+            with self.conn:
+                self.conn.executemany("DELETE FROM Segment WHERE filename=?", [(file[0],) for file in files])
+                self.conn.executemany("INSERT INTO Segment (filename, idx, instrument, length, markov_order, key, "
+                                      "notes, durations) VALUES(?,?,?,?,?,?,?,?)", rows)
+        except Error as e:
+            print(e)
+
+    def fetch_segments(self, filename=None, key=None, min_length=None, max_length=None, indices=None, limit=None,
+                       offset=0):
+        conditions = []
+        params = []
+        if filename is not None:
+            conditions.append("filename=?")
+            params.append(filename)
+        if key is not None:
+            conditions.append("key=?")
+            params.append(key)
+        if min_length is not None:
+            conditions.append("length>=?")
+            params.append(min_length)
+        if max_length is not None:
+            conditions.append("length<=?")
+            params.append(max_length)
+        if indices is not None:
+            conditions.append(f"idx IN ({','.join('?' * len(indices))})")
+            params.extend(indices)
+
+        query = "SELECT filename, idx, instrument, length, markov_order, key, notes, durations FROM Segment"
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY filename, idx"
+        if limit is not None or offset:
+            # sqlite only takes an offset after a limit, -1 means no limit
+            query += " LIMIT ? OFFSET ?"
+            params.extend([-1 if limit is None else limit, offset])
+
+        rows = self._fetch(query, params)
+
+        notes = self.decode([np.frombuffer(row[6], dtype=np.int32) for row in rows])
+        return [SegmentRecord(*row[:6], tokens, np.frombuffer(row[7], dtype=np.float64))
+                for row, tokens in zip(rows, notes)]
+
+    def get_segments(self, filename):
+        records = self.fetch_segments(filename=filename)
+        return [r.notes for r in records], [r.durations for r in records], records[0].key
+
+    def token_ids(self, tokens):
+        unique = set(tokens)
+        missing = [(token,) for token in unique if token not in self._token_ids]
+        if missing:
             try:
-                update_query = "UPDATE Sequence SET sequences = ?, durations = ?, key = ?  WHERE filename=?"
-                self._insert(update_query, update_params)
+                cur = self.conn.cursor()
+                cur.executemany("INSERT OR IGNORE INTO Vocabulary (token) VALUES(?)", missing)
+                self.conn.commit()
+                cur.close()
             except Error as e:
                 print(e)
+            self.load_vocabulary()
+        return np.array([self._token_ids[token] for token in tokens], dtype=np.int32)
 
-    def get_sequence(self, filename):
-        rows = self._fetch(
-            "SELECT sequences FROM Sequence WHERE filename=?", (filename,))
-        return rows[0][0]
+    def decode(self, ids):
+        # Pick up tokens added through other connections
+        if any(len(a) and a.max() >= len(self._tokens) for a in ids):
+            self.load_vocabulary()
+        return [self._tokens[a].tolist() for a in ids]
 
-    def get_durations(self, filename):
-        rows = self._fetch(
-            "SELECT durations FROM Sequence WHERE filename=?", (filename,))
-        return rows[0][0]
+    def load_vocabulary(self):
+        rows = self._fetch("SELECT id, token FROM Vocabulary")
+        size = max((row[0] for row in rows), default=-1) + 1
+        self._tokens = np.empty(size, dtype=object)
+        for token_id, token in rows:
+            self._tokens[token_id] = token
+        self._token_ids = {token: token_id for token_id, token in rows}
+
+    def insert_or_update_extraction(self, file_hash, backend, version, instruments, notes, durations, key):
+        params = [file_hash, backend, version, self.to_json(instruments), self.to_json(notes), self.to_json(durations),
+                  key]
+        try:
+            query = "INSERT INTO Extraction (hash, backend, version, instruments, notes, durations, key) " \
+                    "VALUES(?,?,?,?,?,?,?) ON CONFLICT(hash, backend, version) DO UPDATE SET " \
+                    "instruments = excluded.instruments, notes = excluded.notes, durations = excluded.durations, " \
+                    "key = excluded.key"
+            self._insert(query, params)
+        except Error as e:
+            print(e)
+
+    def get_extraction(self, file_hash, backend, version):
+        # Keyed by file contents, so moved or copied files still hit and tokens from an older extractor never do
+        rows = self._fetch("SELECT instruments, notes, durations, key FROM Extraction "
+                           "WHERE hash=? AND backend=? AND version=?", (file_hash, backend, version))
+        if len(rows) == 0:
+            return None
+        instruments, notes, durations, key = rows[0]
+        return self.to_lst(instruments), self.to_lst(notes), self.to_lst(durations), key
+
+    def insert_or_update_model(self, filename, backend, version, instrument, order, kind, file_hash, model):
+        params = [filename, backend, version, instrument, order, kind, file_hash, model]
+        try:
+            query = "INSERT INTO Model (filename, backend, version, instrument, markov_order, kind, hash, model) " \
+                    "VALUES(?,?,?,?,?,?,?,?) ON CONFLICT(filename, backend, version, instrument, markov_order, kind) " \
+                    "DO UPDATE SET hash = excluded.hash, model = excluded.model"
+            self._insert(query, params)
+        except Error as e:
+            print(e)
 
-    def get_key(self, filename):
-        rows = self._fetch(
-            "SELECT key FROM Sequence WHERE filename=?", (filename,))
+    def get_model(self, filename, backend, version, instrument, order, kind, file_hash):
+        # Models fitted on an older version of the file, or on another extractor's tokens, are ignored
+        rows = self._fetch("SELECT model FROM Model WHERE filename=? AND backend=? AND version=? AND instrument=? "
+                           "AND markov_order=? AND kind=? AND hash=?",
+                           (filename, backend, version, instrument, order, kind, file_hash))
+        if len(rows) == 0:
+            return None
         return rows[0][0]
 
     @staticmethod
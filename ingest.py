@@ -0,0 +1,117 @@
+import argparse
+import hashlib
+import os
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import midi_helper as helper
+from database import Database
+from markov import Markov
+
+
+def process_file(path, instrument, order, max_length, backend, backoff, joint, corpus):
+    # Runs inside a worker process, any failure is reported back instead of raised
+    start = time.perf_counter()
+    try:
+        database = Database()
+        # Lazy, so a raw extraction that misses the cache streams its tokens straight into the counters
+        midi_extraction = helper.ExtractMidi(path, database, backend, lazy=True)
+
+        markov_chain = Markov(order, backoff, joint)
+
+        # Counts for the corpus wide model, merged by the parent as files finish
+        counters = None
+        if corpus:
+            counters = markov_chain.count_stream(midi_extraction.iter_tokens(instrument))
+
+        models = markov_chain.load_or_fit(database, os.path.basename(path), instrument, midi_extraction, counters)
+        sequences_notes, sequence_durations = markov_chain.generate_segments(models, max_length)
+
+        return (sequences_notes, sequence_durations, str(midi_extraction.get_key()), counters,
+                midi_extraction.get_hash(), None, time.perf_counter() - start)
+    except Exception:
+        return None, None, None, None, None, traceback.format_exc(), time.perf_counter() - start
+
+
+def store_corpus_model(database, midi_dir, backend, instrument, markov_chain, counters, hashes):
+    # Keyed by the directory, with a hash over every member file so a changed corpus is refitted
+    filename = f"corpus:{os.path.normpath(midi_dir)}"
+    corpus_hash = hashlib.sha1("".join(sorted(hashes)).encode()).hexdigest()
+    for kind, counter in zip(markov_chain.kinds, counters):
+        model = markov_chain.from_counter(counter)
+        database.insert_or_update_model(filename, backend, helper.ExtractMidi.EXTRACTOR_VERSIONS[backend], instrument,
+                                        markov_chain.order, kind, corpus_hash, model.dumps())
+        print(f"Stored corpus {kind} model with {len(model)} contexts as {filename}")
+
+
+def ingest(midi_dir, workers, instrument, order, max_length, backend, backoff, joint, batch_size, corpus):
+    files = sorted(f for f in os.listdir(midi_dir) if f.endswith(".mid"))
+    database = Database()
+    failed = []
+    # Finished files waiting to be written in one transaction
+    pending = []
+    corpus_counters = None
+    corpus_hashes = []
+    start = time.perf_counter()
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(process_file, os.path.join(midi_dir, file), instrument, order, max_length,
+                                   backend, backoff, joint, corpus): file for file in files}
+        for count, future in enumerate(as_completed(futures), start=1):
+            file = futures[future]
+            try:
+                sequences_notes, sequence_durations, key, counters, file_hash, error, elapsed = future.result()
+            except Exception:
+                # The worker process itself died
+                error, elapsed = traceback.format_exc(), 0.0
+
+            if error is None:
+                if counters is not None and counters[0].states:
+                    if corpus_counters is None:
+                        corpus_counters = counters
+                    else:
+                        for corpus_counter, counter in zip(corpus_counters, counters):
+                            corpus_counter.merge(counter)
+                    corpus_hashes.append(file_hash)
+
+                pending.append((file, sequences_notes, sequence_durations, key, instrument, order))
+                if len(pending) >= batch_size:
+                    database.insert_many_segments(pending)
+                    pending = []
+                print(f"[{count}/{len(files)}] {file} ({elapsed:.2f}s)")
+            else:
+                failed.append(file)
+                print(f"[{count}/{len(files)}] {file} failed ({elapsed:.2f}s)\n{error}")
+
+    if pending:
+        database.insert_many_segments(pending)
+
+    if corpus_counters is not None:
+        store_corpus_model(database, midi_dir, backend, instrument, Markov(order, backoff, joint), corpus_counters,
+                           corpus_hashes)
+
+    print(f"Ingested {len(files) - len(failed)}/{len(files)} files in {time.perf_counter() - start:.2f}s")
+    for file in failed:
+        print(f"Failed: {file}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate segments for every midi file and store them in music.db")
+    parser.add_argument("--midi-dir", default="midi")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--instrument", default="Piano")
+    parser.add_argument("--order", type=int, default=3)
+    parser.add_argument("--max-length", type=int, default=4)
+    parser.add_argument("--backend", choices=helper.ExtractMidi.BACKENDS, default="music21")
+    parser.add_argument("--no-backoff", dest="backoff", action="store_false",
+                        help="Use a fixed order chain instead of backing off to shorter contexts")
+    parser.add_argument("--joint", action="store_true",
+                        help="Model notes and durations with one chain over (note, duration) pairs")
+    parser.add_argument("--batch-size", type=int, default=16, help="Files written per database transaction")
+    parser.add_argument("--corpus", action="store_true",
+                        help="Also fit one model over every file and store it in the Model table")
+    args = parser.parse_args()
+
+    ingest(args.midi_dir, args.workers, args.instrument, args.order, args.max_length, args.backend, args.backoff,
+           args.joint, args.batch_size, args.corpus)
@@ -0,0 +1,130 @@
+import numpy as np
+
+
+def cyclic_indices(ids, states, sizes, offsets, step=4):
+    # Flat indices of the next step items in each symbol's cycle, symbols with an empty cycle must be filtered out
+    # Each occurrence is offset by how many earlier occurrences of the same symbol are in ids
+    order = np.argsort(ids, kind='stable')
+    ranked = ids[order]
+    rank = np.empty_like(ids)
+    rank[order] = np.arange(ids.size) - np.searchsorted(ranked, ranked)
+
+    positions = (states[ids, None] + step * rank[:, None] + np.arange(step)) % sizes[ids, None]
+    states = (states + step * np.bincount(ids, minlength=len(states))) % np.maximum(sizes, 1)
+    return (offsets[ids, None] + positions).ravel(), states
+
+
+class LSystem:
+    def __init__(self, rules, symbols=()):
+        # Every symbol gets an integer id, symbols without a rule rewrite to themselves
+        self.rules = rules
+        self.symbols = list(dict.fromkeys([*symbols, *rules, *"".join(rules.values())]))
+        self._ids = {symbol: i for i, symbol in enumerate(self.symbols)}
+
+        # Successors of every symbol laid out back to back, indexed by start and length
+        successors = [[self._ids[char] for char in rules.get(symbol, symbol)] for symbol in self.symbols]
+        self.rule_len = np.array([len(successor) for successor in successors], dtype=np.int64)
+        self.rule_start = np.cumsum(self.rule_len) - self.rule_len
+        self.rule_flat = np.array([i for successor in successors for i in successor], dtype=np.int64)
+
+        # How often each symbol appears in each successor, python ints so deep expansions cannot overflow
+        self.matrix = np.zeros((len(self.symbols), len(self.symbols)), dtype=object)
+        for symbol, successor in enumerate(successors):
+            for i in successor:
+                self.matrix[symbol, i] += 1
+        self._counts = [np.identity(len(self.symbols), dtype=int).astype(object)]
+        self._lengths = [np.ones(len(self.symbols), dtype=int).astype(object)]
+
+    def encode(self, text):
+        return np.array([self._ids[char] for char in text], dtype=np.int64)
+
+    def decode(self, ids):
+        return "".join(self.symbols[i] for i in ids.tolist())
+
+    def counts(self, depth):
+        # Symbol counts of every symbol's expansion at the given depth, one row per symbol
+        while len(self._counts) <= depth:
+            self._counts.append(self.matrix.dot(self._counts[-1]))
+        return self._counts[depth]
+
+    def lengths(self, depth):
+        while len(self._lengths) <= depth:
+            self._lengths.append(self.matrix.dot(self._lengths[-1]))
+        return self._lengths[depth]
+
+    def length(self, ids, n):
+        return int(self.lengths(n)[ids].sum())
+
+    def prefix_counts(self, ids, n, stop):
+        # Symbol counts of the first stop symbols of the expansion, descending into one symbol per level
+        counts = np.zeros(len(self.symbols), dtype=int).astype(object)
+        position = 0
+        for depth in range(n, -1, -1):
+            ends = position + np.cumsum(self.lengths(depth)[ids])
+            before = int(np.searchsorted(ends, stop, side='right'))
+            counts += self.counts(depth)[ids[:before]].sum(axis=0)
+            if before == len(ids) or depth == 0:
+                break
+            if before:
+                position = ends[before - 1]
+            symbol = ids[before]
+            ids = self.rule_flat[self.rule_start[symbol]:self.rule_start[symbol] + self.rule_len[symbol]]
+        return counts
+
+    def symbols_range(self, ids, n, start, stop):
+        chunks = list(self.iter_range(ids, n, start, stop))
+        if not chunks:
+            return np.zeros(0, dtype=np.int64)
+        return np.concatenate(chunks)
+
+    def iter_range(self, ids, n, start, stop, chunk_size=4096):
+        # Like iter_expand, but whole subtrees outside [start, stop) are skipped by their length
+        stack = []
+        self.__push(stack, np.asarray(ids, dtype=np.int64), n, chunk_size)
+        position = 0
+        while stack and position < stop:
+            ids, depth = stack.pop()
+            ends = position + np.cumsum(self.lengths(depth)[ids])
+            first = int(np.searchsorted(ends, start, side='right'))
+            last = int(np.searchsorted(ends, stop, side='left')) + 1
+            if first:
+                position = ends[first - 1]
+            if last < len(ids):
+                # Everything after the window is dropped
+                stack.clear()
+            ids = ids[first:last]
+            if not ids.size:
+                continue
+            if depth == 0:
+                position += ids.size
+                yield ids
+            else:
+                self.__push(stack, self.rewrite(ids), depth - 1, chunk_size)
+
+    def rewrite(self, ids):
+        # One parallel rewrite, each output position gathers from its symbol's successor
+        lengths = self.rule_len[ids]
+        offsets = np.repeat(self.rule_start[ids] - (np.cumsum(lengths) - lengths), lengths)
+        return self.rule_flat[offsets + np.arange(offsets.size)]
+
+    def expand(self, ids, n):
+        for _ in range(n):
+            ids = self.rewrite(ids)
+        return ids
+
+    def iter_expand(self, ids, n, chunk_size=4096):
+        # Depth first, so only one chunk per level is held in memory at a time
+        stack = []
+        self.__push(stack, np.asarray(ids, dtype=np.int64), n, chunk_size)
+        while stack:
+            ids, depth = stack.pop()
+            if depth == 0:
+                yield ids
+            else:
+                self.__push(stack, self.rewrite(ids), depth - 1, chunk_size)
+
+    @staticmethod
+    def __push(stack, ids, depth, chunk_size):
+        # Chunks go on in reverse so they come off the stack in order
+        for start in range((ids.size - 1) // chunk_size * chunk_size, -1, -chunk_size):
+            stack.append((ids[start:start + chunk_size], depth))
@@ -1,61 +1,393 @@
+import io
+from itertools import islice
+
 import numpy as np
-import pandas as pd
 
 
-class Markov:
+class MarkovModel:
+    def __init__(self, order, states, contexts, indptr, indices, counts, next_context, start, starts=None,
+                 note_states=None, duration_states=None):
+        self.order = order
+        # Token for every state id, packed note_id * len(duration_states) + duration_id for joint chains
+        self.states = states
+        self.note_states = note_states
+        self.duration_states = duration_states
+        # Context rows of state ids, one row per context id, left padded with -1 when shorter than order
+        self.contexts = contexts
+        # CSR layout: successors of context c are indices[indptr[c]:indptr[c + 1]]
+        self.indptr = indptr
+        self.indices = indices
+        self.counts = counts
+        # Context id reached after taking each successor, -1 if never seen as a context
+        self.next_context = next_context
+        # Context the training sequence opens with, used to restart chains at a dead end
+        self.start = start
+        # Full length contexts a chain may begin from
+        self.starts = np.arange(len(contexts)) if starts is None else starts
+        self._sampler = None
+
+    def __len__(self):
+        return len(self.contexts)
+
+    @property
+    def sampler(self):
+        if self._sampler is None:
+            self._sampler = Sampler(self)
+        return self._sampler
+
+    def is_joint(self):
+        return self.note_states is not None
+
+    def unpack(self, sequence):
+        # Split packed joint states back into note and duration tokens
+        note_ids, duration_ids = np.divmod(np.asarray(sequence), len(self.duration_states))
+        return self.note_states[note_ids].tolist(), self.duration_states[duration_ids].tolist()
+
+    def dumps(self):
+        # Alias tables are stored too so a loaded model can sample straight away
+        buffer = io.BytesIO()
+        joint = {'note_states': self.note_states, 'duration_states': self.duration_states} if self.is_joint() else {}
+        np.savez(buffer, order=self.order, states=self.states, contexts=self.contexts, indptr=self.indptr,
+                 indices=self.indices, counts=self.counts, next_context=self.next_context, start=self.start,
+                 starts=self.starts, prob=self.sampler.prob, alias=self.sampler.alias, **joint)
+        return buffer.getvalue()
+
+    @staticmethod
+    def loads(data):
+        arrays = np.load(io.BytesIO(data))
+        starts = arrays['starts'] if 'starts' in arrays else None
+        note_states = arrays['note_states'] if 'note_states' in arrays else None
+        duration_states = arrays['duration_states'] if 'duration_states' in arrays else None
+        model = MarkovModel(int(arrays['order']), arrays['states'], arrays['contexts'], arrays['indptr'],
+                            arrays['indices'], arrays['counts'], arrays['next_context'], int(arrays['start']), starts,
+                            note_states, duration_states)
+        model._sampler = Sampler(model, arrays['prob'], arrays['alias'])
+        return model
+
+
+class Sampler:
+    def __init__(self, model, prob=None, alias=None):
+        self.indptr = model.indptr
+        self.sizes = np.diff(model.indptr)
+        if prob is not None:
+            self.prob = prob
+            self.alias = alias
+            return
+
+        # Alias tables share the CSR layout of the model, one table per context
+        self.prob = np.ones(len(model.indices))
+        self.alias = np.arange(len(model.indices))
+
+        for context in range(len(model)):
+            start, end = model.indptr[context], model.indptr[context + 1]
+            self.__build_table(model.counts[start:end], start)
+
+    def __build_table(self, counts, start):
+        # Vose's alias method
+        scaled = (counts * len(counts) / counts.sum()).tolist()
+        small = [i for i, p in enumerate(scaled) if p < 1]
+        large = [i for i, p in enumerate(scaled) if p >= 1]
+        while small and large:
+            s = small.pop()
+            l = large[-1]
+            self.prob[start + s] = scaled[s]
+            self.alias[start + s] = start + l
+            scaled[l] -= 1 - scaled[s]
+            if scaled[l] < 1:
+                small.append(large.pop())
+
+    def draw(self, contexts, rng=np.random):
+        # Pick a column uniformly, then keep it or take its alias
+        u = rng.random(np.shape(contexts)) * self.sizes[contexts]
+        column = u.astype(np.int64)
+        k = self.indptr[contexts] + column
+        return np.where(u - column < self.prob[k], k, self.alias[k])
+
+
+class NgramCounter:
     def __init__(self, order):
         self.order = order
+        # Token for every id, in order of first appearance
+        self.states = []
+        self._ids = {}
+        # Distinct n-grams left padded with -1 and how often each occurred
+        self.ngrams = np.empty((0, order + 1), dtype=np.int64)
+        self.weights = np.empty(0, dtype=np.int64)
+        # Last ids of the stream being fed, so n-grams spanning two chunks are counted once
+        self._history = np.full(order, -1, dtype=np.int64)
+
+    def __token_ids(self, tokens):
+        ids = np.empty(len(tokens), dtype=np.int64)
+        for i, token in enumerate(tokens):
+            token_id = self._ids.get(token)
+            if token_id is None:
+                token_id = self._ids[token] = len(self.states)
+                self.states.append(token)
+            ids[i] = token_id
+        return ids
+
+    @staticmethod
+    def rows(ids, order):
+        # Every position with the order tokens before it, -1 where the stream has not started yet
+        padded = np.concatenate((np.full(order, -1, dtype=np.int64), ids))
+        return np.lib.stride_tricks.sliding_window_view(padded, order + 1)
+
+    def update(self, tokens, chunk_size=4096):
+        # Count the n-grams of one token stream, streams never join across updates
+        self._history = np.full(self.order, -1, dtype=np.int64)
+        tokens = iter(tokens)
+        chunk = list(islice(tokens, chunk_size))
+        while chunk:
+            self.feed(chunk)
+            chunk = list(islice(tokens, chunk_size))
+        return self
+
+    def feed(self, tokens):
+        # Continue the current stream with the next chunk of tokens
+        padded = np.concatenate((self._history, self.__token_ids(tokens)))
+        rows = np.lib.stride_tricks.sliding_window_view(padded, self.order + 1)
+        self.__add(rows, np.ones(len(rows), dtype=np.int64))
+        self._history = padded[len(padded) - self.order:]
+
+    def merge(self, other):
+        if other.order != self.order:
+            raise ValueError(f"Cannot merge counts of order {other.order} into order {self.order}")
+        # Translate the other counter's ids into ours
+        mapping = self.__token_ids(other.states)
+        rows = np.where(other.ngrams >= 0, mapping[other.ngrams], -1)
+        self.__add(rows, other.weights)
+        return self
+
+    def __add(self, rows, weights):
+        # Fold the new rows into the distinct n-gram table so memory follows the model size
+        self.ngrams, inverse = np.unique(np.vstack((self.ngrams, rows)), axis=0, return_inverse=True)
+        self.weights = np.bincount(inverse.reshape(-1), weights=np.concatenate((self.weights, weights)),
+                                   minlength=len(self.ngrams)).astype(np.int64)
+
+
+class Markov:
+    def __init__(self, order, backoff=False, joint=False):
+        self.order = order
+        # Fall back to shorter contexts instead of reaching dead ends
+        self.backoff = backoff
+        # Model (note, duration) pairs with one chain instead of two independent ones
+        self.joint = joint
+
+    @property
+    def kinds(self):
+        # Names the fitted models are stored under
+        suffix = "_backoff" if self.backoff else ""
+        if self.joint:
+            return ["joint" + suffix]
+        return ["notes" + suffix, "durations" + suffix]
 
     def transition_matrix(self, transitions):
-        unique_states, size = np.unique(transitions, return_counts=True)
-        n = len(unique_states)
-
-        sequences = {}
-
-        for i in range(len(transitions)):
-            if len(transitions[i:i + self.order + 1]) == self.order + 1:
-                key = ",".join(transitions[i:i + self.order + 1])
-                if key not in sequences:
-                    sequences[key] = 1
-                else:
-                    sequences[key] += 1
-
-        m = np.zeros((len(sequences), n), int)
-
-        rows = []
-
-        for i, (key, value) in enumerate(sequences.items()):
-            splits = key.split(",")
-            column = splits[self.order]
-            j = np.where(unique_states == column)[0][0]
-            m[i][j] = value
-            rows.append(",".join(splits[:self.order]))
-
-        df = pd.DataFrame(m)  # convert to dataframe
-
-        # Set axis labels
-        df = df.set_axis(rows)
-        df = df.set_axis(unique_states, axis=1)
-
-        # Combine rows with same keys
-        df = df.groupby(df.index).sum()
-
-        # normalise rows by sum
-        df = df.div(df.sum(axis=1), axis=0)
-
-        return df
-
-    def generate_sequence(self, transition_mat, length):
-        cur = transition_mat.sample()
-        sequence = cur.index.values[0].split(",")
-        columns = list(transition_mat.columns.values)
-        for i in range(length - self.order):
-            probs = cur.values.flatten().tolist()
-            state_index = np.random.choice(cur.size, p=probs)
-            state = columns[state_index]
-            if self.order > 1:
-                cur = transition_mat.loc[[",".join(sequence[i + 1:i + self.order]) + f",{state}"]]
+        # Map every token to an integer id once
+        states, ids = np.unique(np.asarray(transitions), return_inverse=True)
+
+        if len(ids) <= self.order:
+            raise ValueError(f"Need more than {self.order} tokens to fit an order {self.order} chain")
+
+        rows = NgramCounter.rows(ids.reshape(-1), self.order)
+        return self.fit_counts(states, rows, np.ones(len(rows), dtype=np.int64))
+
+    def fit_counts(self, states, rows, weights):
+        # rows hold n-grams of length order + 1 left padded with -1, weights how often each occurred
+        if not np.any(rows[:, 0] >= 0):
+            raise ValueError(f"Need more than {self.order} tokens to fit an order {self.order} chain")
+        if self.backoff:
+            return self.__backoff_matrix(states, rows, weights)
+        return self.__fixed_matrix(states, rows, weights)
+
+    def from_counter(self, counter):
+        if counter.order != self.order:
+            raise ValueError(f"Counter of order {counter.order} cannot fit an order {self.order} chain")
+        if not self.joint:
+            return self.fit_counts(np.array(counter.states), counter.ngrams, counter.weights)
+
+        # Joint tokens are (note, duration) pairs, pack them into single integers
+        note_states, note_ids = np.unique([note for note, _ in counter.states], return_inverse=True)
+        duration_states, duration_ids = np.unique([duration for _, duration in counter.states], return_inverse=True)
+        states = note_ids.reshape(-1) * len(duration_states) + duration_ids.reshape(-1)
+        model = self.fit_counts(states, counter.ngrams, counter.weights)
+        model.note_states = note_states
+        model.duration_states = duration_states
+        return model
+
+    def __fixed_matrix(self, states, rows, weights):
+        n = len(states)
+
+        # Only complete n-grams of length order + 1
+        full = rows[:, 0] >= 0
+        ngrams, weights = rows[full], weights[full]
+
+        contexts, context_ids = np.unique(ngrams[:, :self.order], axis=0, return_inverse=True)
+        context_ids = context_ids.reshape(-1)
+
+        # Count (context, next state) pairs, sorted by context so they form CSR rows
+        pairs, inverse = np.unique(context_ids * n + ngrams[:, self.order], return_inverse=True)
+        counts = np.bincount(inverse.reshape(-1), weights=weights).astype(np.int64)
+        row, indices = np.divmod(pairs, n)
+        indptr = np.zeros(len(contexts) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(row, minlength=len(contexts)), out=indptr[1:])
+
+        # Resolve the context reached after each transition
+        shifted = np.column_stack((contexts[row, 1:], indices))
+        combined, inverse = np.unique(np.vstack((contexts, shifted)), axis=0, return_inverse=True)
+        inverse = inverse.reshape(-1)
+        lookup = np.full(len(combined), -1, dtype=np.int64)
+        lookup[inverse[:len(contexts)]] = np.arange(len(contexts))
+        next_context = lookup[inverse[len(contexts):]]
+
+        return MarkovModel(self.order, states, contexts, indptr, indices, counts, next_context,
+                           context_ids[0])
+
+    def __backoff_matrix(self, states, rows, weights):
+        n = len(states)
+        k = self.order
+
+        # Build a trie of every context up to length order in one pass over the rows. The root is the
+        # empty context and each child extends its parent's context by one token further back in time.
+        node = np.zeros(len(rows), dtype=np.int64)
+        keys = [np.empty(0, dtype=np.int64)]
+        contexts = [np.full((1, k), -1, dtype=np.int64)]
+        pair_nodes, pair_next, pair_weights = [node], [rows[:, k]], [weights]
+        offset = 1
+        for o in range(1, k + 1):
+            present = rows[:, k - o] >= 0
+            rows, weights = rows[present], weights[present]
+            level_keys, inverse = np.unique(node[present] * n + rows[:, k - o], return_inverse=True)
+            parent, token = np.divmod(level_keys, n)
+
+            level_contexts = contexts[-1][parent - (offset - len(contexts[-1]))]
+            level_contexts[:, k - o] = token
+
+            level_start = offset
+            node = offset + inverse.reshape(-1)
+            keys.append(level_keys)
+            contexts.append(level_contexts)
+            pair_nodes.append(node)
+            pair_next.append(rows[:, k])
+            pair_weights.append(weights)
+            offset += len(level_keys)
+
+        # Keys of every node below the root, node i + 1 has key i. Parents of each level come
+        # from the level before, so the concatenated keys are already sorted.
+        keys = np.concatenate(keys)
+        contexts = np.concatenate(contexts)
+
+        # Count (context, next state) pairs across every level, sorted by context so they form CSR rows
+        pairs, inverse = np.unique(np.concatenate(pair_nodes) * n + np.concatenate(pair_next), return_inverse=True)
+        counts = np.bincount(inverse.reshape(-1), weights=np.concatenate(pair_weights)).astype(np.int64)
+        row, indices = np.divmod(pairs, n)
+        indptr = np.zeros(len(contexts) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(row, minlength=len(contexts)), out=indptr[1:])
+
+        def child(parent, token):
+            key = parent * n + token
+            pos = np.minimum(np.searchsorted(keys, key), len(keys) - 1)
+            return np.where(keys[pos] == key, pos + 1, -1)
+
+        # After taking a successor the chain moves to the longest known suffix of the context plus the
+        # new token. That suffix is never longer than one more token, and the root always matches.
+        next_context = np.zeros(len(indices), dtype=np.int64)
+        current = child(0, indices)
+        active = current >= 0
+        next_context[active] = current[active]
+        for m in range(2, k + 1):
+            token = contexts[row, k - m + 1]
+            active &= token >= 0
+            found = child(np.where(active, current, 0), np.where(active, token, 0))
+            active &= found >= 0
+            current = np.where(active, found, current)
+            next_context[active] = found[active]
+
+        # Chains begin from full length contexts only
+        starts = np.arange(level_start, offset)
+        return MarkovModel(k, states, contexts, indptr, indices, counts, next_context, node[0], starts)
+
+    def generate_sequence(self, model, length):
+        context = np.random.choice(model.starts)
+        sequence = model.contexts[context].tolist()
+        sampler = model.sampler
+        for _ in range(length - self.order):
+            if context < 0:
+                raise KeyError(",".join(model.states[sequence[-self.order:]]))
+            k = sampler.draw(context)
+            sequence.append(model.indices[k])
+            context = model.next_context[k]
+        return model.states[sequence].tolist()
+
+    def generate_batch(self, model, lengths, rng=None):
+        if rng is None:
+            rng = np.random.default_rng()
+        lengths = np.asarray(lengths)
+        sampler = model.sampler
+
+        # Every chain starts from a random context and advances in lockstep
+        context = rng.choice(model.starts, size=len(lengths))
+        steps = max(int(lengths.max()) - self.order, 0)
+        sequences = np.empty((len(lengths), self.order + steps), dtype=np.int64)
+        sequences[:, :self.order] = model.contexts[context]
+        for i in range(steps):
+            k = sampler.draw(context, rng)
+            sequences[:, self.order + i] = model.indices[k]
+            context = model.next_context[k]
+            # Chains that reach a context never seen in training carry on from the opening context
+            context[context < 0] = model.start
+
+        return [model.states[sequence[:max(length, self.order)]].tolist()
+                for sequence, length in zip(sequences, lengths)]
+
+    def count_stream(self, tokens, chunk_size=4096):
+        # Count (note, duration) tokens straight into one counter per chain without building token lists
+        counters = [NgramCounter(self.order) for _ in self.kinds]
+        tokens = iter(tokens)
+        chunk = list(islice(tokens, chunk_size))
+        while chunk:
+            if self.joint:
+                counters[0].feed([(note, str(duration)) for note, duration in chunk])
             else:
-                cur = transition_mat.loc[[f"{state}"]]
-            sequence.append(state)
-        return sequence
+                notes, durations = zip(*chunk)
+                counters[0].feed(notes)
+                counters[1].feed([str(duration) for duration in durations])
+            chunk = list(islice(tokens, chunk_size))
+        return counters
+
+    def load_or_fit(self, database, filename, instrument, midi_extraction, counters=None):
+        # Reuse the fitted models stored for this file, instrument and order when there are any
+        # counters already holding the file's counts are fitted instead of counting the tokens again
+        file_hash = midi_extraction.get_hash()
+        backend = midi_extraction.get_backend()
+        version = midi_extraction.get_version()
+        stored = [database.get_model(filename, backend, version, instrument, self.order, kind, file_hash)
+                  for kind in self.kinds]
+        if all(model is not None for model in stored):
+            return [MarkovModel.loads(model) for model in stored]
+
+        if counters is None:
+            counters = self.count_stream(midi_extraction.iter_tokens(instrument))
+        if not counters[0].states:
+            raise ValueError(f"No {instrument} notes found")
+
+        models = [self.from_counter(counter) for counter in counters]
+        for kind, model in zip(self.kinds, models):
+            database.insert_or_update_model(filename, backend, version, instrument, self.order, kind, file_hash,
+                                            model.dumps())
+        return models
+
+    def generate_segments(self, models, max_length, count=15, rng=None):
+        if rng is None:
+            rng = np.random.default_rng()
+
+        # Generate segments of length some power 2^n using the markov chains
+        lengths = 2 ** rng.integers(2, max_length + 1, size=count)
+        if self.joint:
+            # One sampling pass gives both notes and durations
+            model = models[0]
+            sequences = [model.unpack(sequence) for sequence in self.generate_batch(model, lengths, rng)]
+            return [notes for notes, _ in sequences], [durations for _, durations in sequences]
+
+        sequences_notes = self.generate_batch(models[0], lengths, rng)
+        sequence_durations = self.generate_batch(models[1], lengths, rng)
+        return sequences_notes, sequence_durations
@@ -1,17 +1,22 @@
-import os
+import hashlib
+from array import array
 from math import floor
 from shutil import move
 
 import numpy as np
 from music21 import converter, instrument, note, chord
 from music21.chord import Chord
-from music21.midi.translate import streamToMidiFile
 from music21.note import Rest
 from music21.pitch import PitchException, Pitch
 from music21.stream import Part
 import string
 from random import choice
 
+from lsystem import LSystem, cyclic_indices
+from playback import player
+from search import search_rules
+from smf import MidiReader, MidiWriter, chord_pitches, pitch_name, write_midi
+
 
 class Generate:
     def __init__(self, segments, rules):
@@ -31,21 +36,84 @@ class Generate:
         return dict, alphabet_used
 
     def rewriting_system(self, axiom, n):
-        out = ""
-        for char in axiom:
-            if char in self.rules:
-                out += self.rules[char]
-            else:
-                out += char
-        n -= 1
-        if n > 0:
-            return self.rewriting_system(out, n)
-        return out
-
-    def convert_to_segments(self, melody):
-        states = {}
+        # At least one rewrite is always applied
+        lsystem = LSystem(self.rules, axiom)
+        return lsystem.decode(lsystem.expand(lsystem.encode(axiom), max(n, 1)))
+
+    def iter_rewriting_system(self, axiom, n, chunk_size=4096):
+        # Same symbols as rewriting_system without building the whole string
+        lsystem = LSystem(self.rules, axiom)
+        for ids in lsystem.iter_expand(lsystem.encode(axiom), max(n, 1), chunk_size):
+            yield from lsystem.decode(ids)
+
+    def expansion_length(self, axiom, n):
+        lsystem = LSystem(self.rules, axiom)
+        return lsystem.length(lsystem.encode(axiom), max(n, 1))
+
+    def convert_window(self, axiom, n, start, stop):
+        # Notes of symbols [start, stop) of the expansion, each segment resumes where its earlier occurrences left off
+        lsystem = LSystem(self.rules, axiom)
+        ids = lsystem.encode(axiom)
+        counts = lsystem.prefix_counts(ids, max(n, 1), start)
+        states = {symbol: 4 * counts[i] for i, symbol in enumerate(lsystem.symbols) if symbol in self.dict}
+        return self.convert_to_segments(lsystem.decode(lsystem.symbols_range(ids, max(n, 1), start, stop)), states)
+
+    def iter_segments(self, axiom, n, chunk_size=64, start=0, stop=None):
+        # Yields (notes, durations) chunks of chunk_size notes while the expansion is still being walked
+        lsystem = LSystem(self.rules, axiom)
+        ids = lsystem.encode(axiom)
+        n = max(n, 1)
+        if stop is None:
+            stop = lsystem.length(ids, n)
+
+        # Notes and durations of every segment back to back, indexed by symbol id
+        segments = [self.dict.get(symbol) for symbol in lsystem.symbols]
+        sizes = np.array([len(segment.get_notes()) if segment else 0 for segment in segments], dtype=np.int64)
+        offsets = np.cumsum(sizes) - sizes
+        flat_notes = np.array([note for segment in segments if segment for note in segment.get_notes()],
+                              dtype=object)
+        flat_durations = np.array([duration for segment in segments if segment
+                                   for duration in segment.get_durations()], dtype=float)
+
+        # Cyclic position of every segment, resumed from the symbols before the start of the window
+        counts = lsystem.prefix_counts(ids, n, start)
+        states = np.array([4 * count % size if size else 0 for count, size in zip(counts, sizes)], dtype=np.int64)
+
+        notes = []
+        durations = []
+        for chunk in lsystem.iter_range(ids, n, start, stop):
+            chunk = chunk[sizes[chunk] > 0]
+            if not chunk.size:
+                continue
+
+            indices, states = cyclic_indices(chunk, states, sizes, offsets)
+
+            notes.extend(flat_notes[indices].tolist())
+            durations.extend(flat_durations[indices].tolist())
+            while len(notes) >= chunk_size:
+                yield notes[:chunk_size], durations[:chunk_size]
+                del notes[:chunk_size], durations[:chunk_size]
+
+        if notes:
+            yield notes, durations
+
+    def export_midi(self, axiom, n, filename, chunk_size=64, stop=None, do_prune=False, do_quantize=False):
+        # Writes the composition as it is generated, without holding all of its notes
+        # Each chunk is pruned on its own and quantized from the bar position the previous chunk ended on
+        with open(filename, 'wb') as f:
+            writer = MidiWriter(f)
+            bar = 0
+            for notes, durations in self.iter_segments(axiom, n, chunk_size, stop=stop):
+                segment = Segment(notes, filename, 0, durations, "", do_prune, False)
+                if do_quantize:
+                    bar = segment.quantize(bar)
+                writer.write(segment.notes, segment.durations)
+            writer.close()
+
+    def convert_to_segments(self, melody, states=None):
+        states = dict(states or {})
         for key, _ in self.dict.items():
-            states[key] = 0
+            states.setdefault(key, 0)
 
         notes = []
         durations = []
@@ -76,6 +144,14 @@ class Generate:
         print(rules)
         self.rules = rules
 
+    def search_rules(self, count=1000, k=10, iterations=4, metric="smoothness", workers=None):
+        # Keeps the best scoring of count random rule sets and returns the top k with their scores
+        segments = {symbol: self.dict[symbol].get_notes() for symbol in self.alphabet}
+        results = search_rules(segments, count, k, iterations, metric, workers)
+        print(results)
+        self.rules = results[0][1]
+        return results
+
 
 class Segment:
     def __init__(self, notes, filename, index, durations, key, do_prune, do_quantize):
@@ -84,7 +160,8 @@ class Segment:
         self.filename = filename
         self.index = index
         self.key = key
-        self.part = self.__to_part()
+        # music21 Part built on first use, only needed for drawing and midi export
+        self._part = None
 
         if do_prune:
             self.prune()
@@ -92,6 +169,12 @@ class Segment:
         if do_quantize:
             self.quantize()
 
+    @property
+    def part(self):
+        if self._part is None:
+            self._part = self.__to_part()
+        return self._part
+
     def __to_part(self):
         part = Part()
         part.append(instrument.Piano())
@@ -106,52 +189,47 @@ class Segment:
 
         return part
 
+    def to_midi(self):
+        # Standard midi file bytes written directly from the notes, no music21 Part needed
+        return write_midi(self.notes, self.durations)
+
     def write_to_midi(self, export=False, filename=None):
-        mf = streamToMidiFile(self.part)
-        if export:
-            mf.open(filename, 'wb')
-        else:
-            mf.open(f"tmp/{self.index}_{self.filename}", 'wb')
-        mf.write()
-        mf.close()
+        if not export:
+            filename = f"tmp/{self.index}_{self.filename}"
+        with open(filename, 'wb') as f:
+            f.write(self.to_midi())
 
     def play(self):
-        # Play midi file using timidity binary
-        self.write_to_midi()
-
+        # Pipe the midi bytes straight to the synthesizer, no temporary file
         try:
-            os.system(f"timidity -Os tmp/{self.index}_{self.filename}")
+            player.play(self.to_midi())
         except Exception as e:
             print(f"Music could not be played due to: {e}")
 
-        # Remove temporary midi file from /tmp
-        os.remove(f"tmp/{self.index}_{self.filename}")
+    def stop(self):
+        player.stop()
 
     def prune(self):
-        notes = self.notes
-        midi = []
-        for elem in notes:
-            if elem != "rest":
-                pitches = Chord(elem).pitches
-                avg = 0
-                for pitch in pitches:
-                    avg += int(pitch.midi)
-                midi.append(avg / len(pitches))
-
-        distances = []
-        for (x, y) in zip(midi, midi[1:]):
-            distances.append(abs(floor(x - y)))
-
-        std = np.std(distances)
-        mean = np.mean(distances)
-
-        for i in range(len(distances)):
-            if distances[i] > mean + (2 * std):
-                notes[i - 1] = self.notes[i]
-        self.notes = notes
-
-    def quantize(self):
-        curr = 0
+        notes = np.array(self.notes, dtype=object)
+
+        # Mean MIDI number of every note or chord, looked up once per distinct token
+        tokens, inverse = np.unique(notes[notes != "rest"].astype(str), return_inverse=True)
+        means = np.array([np.mean(chord_pitches(token)) for token in tokens])
+        midi = means[inverse.reshape(-1)]
+
+        distances = np.abs(np.floor(midi[:-1] - midi[1:]))
+        if len(distances) == 0:
+            return
+
+        # Replace the element before each outlying jump with the note at the jump
+        outliers = np.flatnonzero(distances > distances.mean() + (2 * distances.std()))
+        pruned = notes.copy()
+        pruned[outliers - 1] = notes[outliers]
+        self.notes = pruned.tolist()
+        self._part = None
+
+    def quantize(self, curr=0):
+        # curr is the position in the bar to start from, the position at the end is returned
         for i in range(len(self.durations)):
             if curr % 4 == 0:
                 curr = self.durations[i]
@@ -160,6 +238,8 @@ class Segment:
                 curr = 0
             else:
                 curr += self.durations[i]
+        self._part = None
+        return curr
 
     def get_notes(self):
         return self.notes
@@ -171,40 +251,243 @@ class Segment:
         return self.durations
 
 
+class SegmentStore:
+    def __init__(self):
+        # Pitches of every note back to back, note i owns pitches[note_offsets[i]:note_offsets[i + 1]]
+        self._pitches = array('B')
+        self._note_offsets = array('I', [0])
+        self._durations = array('f')
+        # Segment i owns notes segment_offsets[i]:segment_offsets[i + 1]
+        self._segment_offsets = array('I', [0])
+        self._indices = array('I')
+
+        # Filenames and keys are shared between segments and stored once
+        self._filename_ids = array('I')
+        self._key_ids = array('I')
+        self._strings = []
+        self._string_ids = {}
+
+    def __len__(self):
+        return len(self._indices)
+
+    def __getitem__(self, position):
+        if not 0 <= position < len(self):
+            raise IndexError(position)
+        return SegmentView(self, position)
+
+    def __iter__(self):
+        return (SegmentView(self, position) for position in range(len(self)))
+
+    def __string_id(self, value):
+        string_id = self._string_ids.get(value)
+        if string_id is None:
+            string_id = self._string_ids[value] = len(self._strings)
+            self._strings.append(value)
+        return string_id
+
+    def add(self, notes, durations, filename, index, key):
+        for token in notes:
+            self._pitches.extend(chord_pitches(token))
+            self._note_offsets.append(len(self._pitches))
+        self._durations.extend(float(d) for d in durations)
+        self._segment_offsets.append(len(self._note_offsets) - 1)
+        self._indices.append(index)
+        self._filename_ids.append(self.__string_id(filename))
+        self._key_ids.append(self.__string_id(key))
+        return SegmentView(self, len(self) - 1)
+
+    def add_records(self, records):
+        # Records as returned by Database.fetch_segments
+        for record in records:
+            self.add(record.notes, record.durations, record.filename, record.index, record.key)
+
+    def notes(self, position):
+        start, end = self._segment_offsets[position], self._segment_offsets[position + 1]
+        offsets = self._note_offsets[start:end + 1]
+        pitches = self._pitches[offsets[0]:offsets[-1]]
+        base = offsets[0]
+        return [' '.join(pitch_name(p) for p in pitches[a - base:b - base]) if b > a else 'rest'
+                for a, b in zip(offsets, offsets[1:])]
+
+    def durations(self, position):
+        start, end = self._segment_offsets[position], self._segment_offsets[position + 1]
+        durations = np.frombuffer(self._durations[start:end], dtype=np.float32).astype(np.float64)
+        # float32 cannot hold thirds exactly, snap values back onto the 1/12 quarter grid they came from
+        snapped = np.round(durations * 12) / 12
+        return np.where(np.abs(snapped - durations) < 1e-6, snapped, durations).tolist()
+
+    def filename(self, position):
+        return self._strings[self._filename_ids[position]]
+
+    def index(self, position):
+        return self._indices[position]
+
+    def key(self, position):
+        return self._strings[self._key_ids[position]]
+
+
+class SegmentView:
+    __slots__ = ('_store', '_position')
+
+    def __init__(self, store, position):
+        self._store = store
+        self._position = position
+
+    @property
+    def filename(self):
+        return self._store.filename(self._position)
+
+    @property
+    def index(self):
+        return self._store.index(self._position)
+
+    def get_notes(self):
+        return self._store.notes(self._position)
+
+    def get_durations(self):
+        return self._store.durations(self._position)
+
+    def get_key(self):
+        return self._store.key(self._position)
+
+    def to_segment(self, do_prune=False, do_quantize=False):
+        return Segment(self.get_notes(), self.filename, self.index, self.get_durations(), self.get_key(), do_prune,
+                       do_quantize)
+
+
 class ExtractMidi:
-    def __init__(self, filename):
+    BACKENDS = ('music21', 'raw')
+    # Bumped whenever a backend's tokens change, so cached extractions and models from older code are not reused
+    EXTRACTOR_VERSIONS = {'music21': 1, 'raw': 2}
+
+    def __init__(self, filename, database=None, backend='music21', lazy=False):
+        if backend not in self.BACKENDS:
+            raise ValueError(f"Unknown midi backend {backend}, expected one of {self.BACKENDS}")
         self._filename = filename
+        self._backend = backend
         self._notes = []
         self._durations = []
-        self.stream = converter.parse(self._filename)
-        self.instruments = instrument.partitionByInstrument(self.stream).parts
+        self._database = database
+
+        # Per instrument token streams, aligned with self.instruments
+        self._part_notes = []
+        self._part_durations = []
+        self.instruments = []
+        self._key = None
+        self._hash = self.__file_hash()
+        # Raw reader kept instead of token lists when a lazy extraction misses the cache
+        self._reader = None
+
+        if not self.__load_cached():
+            if lazy and backend == 'raw':
+                # Tokens are produced on demand by iter_tokens, nothing is cached
+                self._reader = MidiReader(self._filename)
+                self.instruments = self._reader.get_instruments()
+                self._key = self._reader.get_key()
+            else:
+                self.__extract()
+
+    def __load_cached(self):
+        if self._database is None:
+            return False
+
+        cached = self._database.get_extraction(self._hash, self._backend, self.get_version())
+        if cached is None:
+            return False
+
+        instruments, notes, durations, key = cached
+        self.instruments = instruments
+        self._part_notes = notes
+        self._part_durations = durations
+        self._key = key
+        return True
+
+    def __file_hash(self):
+        with open(self._filename, 'rb') as f:
+            return hashlib.sha1(f.read()).hexdigest()
+
+    def __extract(self):
+        if self._backend == 'raw':
+            self.__extract_raw()
+        else:
+            self.__extract_music21()
+
+        if self._database is not None:
+            self._database.insert_or_update_extraction(self._hash, self._backend, self.get_version(), self.instruments,
+                                                       self._part_notes, self._part_durations, self._key)
+
+    def __extract_raw(self):
+        # Read note events straight from the file bytes, no music21 streams involved
+        reader = MidiReader(self._filename)
+        for name in reader.get_instruments():
+            notes, durations = reader.get_tokens(name)
+            self.instruments.append(name)
+            self._part_notes.append(notes)
+            self._part_durations.append(durations)
+
+        self._key = reader.get_key()
+
+    def __extract_music21(self):
+        stream = converter.parse(self._filename)
+        for part in instrument.partitionByInstrument(stream).parts:
+            notes = []
+            durations = []
+            for element in part.recurse():
+                # notes
+                if isinstance(element, note.Note):
+                    notes.append(str(element.pitch))
+                    durations.append(float(element.quarterLength))
+                # chords
+                elif isinstance(element, chord.Chord):
+                    notes.append(' '.join(str(n.pitch)
+                                          for n in element))
+                    durations.append(float(element.quarterLength))
+                # rests
+                elif isinstance(element, note.Rest):
+                    notes.append(element.name)
+                    durations.append(float(element.quarterLength))
+
+            self.instruments.append(str(part))
+            self._part_notes.append(notes)
+            self._part_durations.append(durations)
+
+        self._key = str(stream.analyze('key'))
 
     def parse_midi(self, inst='Piano'):
-        for part in self.instruments:
-            # select elements of only inst
-            if inst in str(part):
-                notes_to_parse = part.recurse()
-                for element in notes_to_parse:
-                    # notes
-                    if isinstance(element, note.Note):
-                        self._notes.append(str(element.pitch))
-                        self._durations.append(element.quarterLength)
-                    # chords
-                    elif isinstance(element, chord.Chord):
-                        self._notes.append(' '.join(str(n.pitch)
-                                                    for n in element))
-                        self._durations.append(element.quarterLength)
-                    # rests
-                    elif isinstance(element, note.Rest):
-                        self._notes.append(element.name)
-                        self._durations.append(element.quarterLength)
+        self._notes = []
+        self._durations = []
+        # select elements of only inst
+        for note_token, duration in self.iter_tokens(inst):
+            self._notes.append(note_token)
+            self._durations.append(duration)
+
+    def iter_tokens(self, inst='Piano'):
+        # Yield (note, duration) tokens of the selected parts without copying them into lists
+        if self._reader is not None:
+            for name in self.instruments:
+                if inst in name:
+                    yield from self._reader.iter_tokens(name)
+            return
+
+        for name, notes, durations in zip(self.instruments, self._part_notes, self._part_durations):
+            if inst in name:
+                yield from zip(notes, durations)
 
     def get_key(self):
-        return self.stream.analyze('key')
+        return self._key
 
     def get_instruments(self):
         return self.instruments
 
+    def get_hash(self):
+        return self._hash
+
+    def get_backend(self):
+        return self._backend
+
+    def get_version(self):
+        return self.EXTRACTOR_VERSIONS[self._backend]
+
     def get_notes(self):
         if not self._notes:
             print("Midi has not been parsed")
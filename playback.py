@@ -0,0 +1,43 @@
+import subprocess
+import threading
+
+
+class Player:
+    def __init__(self, command=("timidity", "-Os", "-")):
+        # timidity reads a whole midi file from stdin when given "-" as the filename
+        self.command = list(command)
+        self._process = None
+        self._lock = threading.Lock()
+
+    def play(self, midi):
+        # Blocks until the music finishes or stop() is called, only one piece plays at a time
+        with self._lock:
+            self.__stop()
+            process = subprocess.Popen(self.command, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL,
+                                       stderr=subprocess.DEVNULL)
+            self._process = process
+
+        try:
+            process.stdin.write(midi)
+            process.stdin.close()
+        except BrokenPipeError:
+            # Stopped before the synthesizer read the whole file
+            pass
+        return process.wait()
+
+    def stop(self):
+        with self._lock:
+            self.__stop()
+
+    def __stop(self):
+        if self._process is not None and self._process.poll() is None:
+            self._process.terminate()
+            self._process.wait()
+        self._process = None
+
+    def is_playing(self):
+        return self._process is not None and self._process.poll() is None
+
+
+# Shared by every segment so plays never overlap
+player = Player()
@@ -14,12 +14,21 @@ from dataclasses import dataclass, fields
 from configparser import ConfigParser
 
 
+# Deepest L-system expansion the settings accept, and the most symbols the generator window renders and draws
+MAX_ITERATIONS = 30
+MAX_WINDOW_SYMBOLS = 2048
+MAX_EXPORT_SYMBOLS = 2 ** 20
+
+
 @dataclass()
 class Settings:
     order: int = 3
     prune: bool = True
     max_length: int = 4
     quantize: bool = True
+    backoff: bool = True
+    joint: bool = False
+    iterations: int = 4
 
 
 class MplCanvas(FigureCanvasQTAgg):
@@ -90,17 +99,46 @@ class SettingsPopup(QWidget):
         self.prune_checkbox.setChecked(self.settings.prune)
         self.layout.addWidget(self.prune_checkbox, 4, 1)
 
+        # Back-off
+        self.backoff_label = QLabel()
+        self.backoff_label.setText("Back off to shorter contexts")
+        self.backoff_label.setAlignment(Qt.AlignCenter)
+        self.layout.addWidget(self.backoff_label, 5, 0)
+        self.backoff_checkbox = QCheckBox()
+        self.backoff_checkbox.setChecked(self.settings.backoff)
+        self.layout.addWidget(self.backoff_checkbox, 5, 1)
+
+        # Joint note and duration chain
+        self.joint_label = QLabel()
+        self.joint_label.setText("Joint note and duration chain")
+        self.joint_label.setAlignment(Qt.AlignCenter)
+        self.layout.addWidget(self.joint_label, 6, 0)
+        self.joint_checkbox = QCheckBox()
+        self.joint_checkbox.setChecked(self.settings.joint)
+        self.layout.addWidget(self.joint_checkbox, 6, 1)
+
+        # L-system iterations
+        self.iterations_label = QLabel()
+        self.iterations_label.setText("L-system iterations")
+        self.iterations_label.setAlignment(Qt.AlignCenter)
+        self.layout.addWidget(self.iterations_label, 7, 0)
+
+        self.iterations_text_field = QLineEdit()
+        self.iterations_text_field.setMaxLength(2)
+        self.iterations_text_field.setText(str(self.settings.iterations))
+        self.layout.addWidget(self.iterations_text_field, 7, 1)
+
         # Save button
         self.button_save = QPushButton()
         self.button_save.setText("Save")
         self.button_save.clicked.connect(self.on_save)
-        self.layout.addWidget(self.button_save, 5, 0)
+        self.layout.addWidget(self.button_save, 8, 0)
 
         # Cancel button
         self.cancel_save = QPushButton()
         self.cancel_save.setText("Cancel")
         self.cancel_save.clicked.connect(self.quit)
-        self.layout.addWidget(self.cancel_save, 5, 1)
+        self.layout.addWidget(self.cancel_save, 8, 1)
 
     def quit(self):
         self.destroy()
@@ -108,12 +146,16 @@ class SettingsPopup(QWidget):
     def on_save(self):
         try:
             # Raise an exception if any value is not positive
-            if int(self.order_text_field.text()) < 1 or int(self.max_length_text_field.text()) < 1:
+            if int(self.order_text_field.text()) < 1 or int(self.max_length_text_field.text()) < 1 \
+                    or not 1 <= int(self.iterations_text_field.text()) <= MAX_ITERATIONS:
                 raise Exception
             settings = Settings(int(self.order_text_field.text()),
                                 self.prune_checkbox.isChecked(),
                                 int(self.max_length_text_field.text()),
-                                self.quantization_checkbox.isChecked())
+                                self.quantization_checkbox.isChecked(),
+                                self.backoff_checkbox.isChecked(),
+                                self.joint_checkbox.isChecked(),
+                                int(self.iterations_text_field.text()))
             self.signals.result.emit(settings)
             self.destroy()
         except Exception as e:
@@ -124,7 +166,7 @@ class SettingsPopup(QWidget):
 
 
 class GeneratorPopup(QWidget):
-    def __init__(self, segment, threadpool):
+    def __init__(self, segment, threadpool, generator=None, settings=None, length=0):
         QWidget.__init__(self)
         self.window().resize(1280, 720)
         self.layout = QGridLayout()
@@ -133,6 +175,10 @@ class GeneratorPopup(QWidget):
         self.threadpool = threadpool
 
         self.segment = segment
+        # The segment only holds the drawn window when the whole composition is longer
+        self.generator = generator
+        self.settings = settings
+        self.length = length
         self.figure = None
         self.now_playing = False
 
@@ -161,12 +207,24 @@ class GeneratorPopup(QWidget):
             worker.signals.finished.connect(self.playing_complete)
             self.now_playing = True
         else:
-            print("Music already playing")
+            # Pressing play again stops the music
+            self.segment.stop()
 
     def export(self):
         filename = QFileDialog.getSaveFileName(
             self, 'Save File', directory="./out", filter="Midi files (*.mid)")
-        if filename[0] != '':
+        if filename[0] == '':
+            return
+        if self.length > MAX_WINDOW_SYMBOLS:
+            # Stream the composition to the file off the GUI thread instead of exporting the window
+            if self.length > MAX_EXPORT_SYMBOLS:
+                print(f"Composition has {self.length} symbols, exporting the first {MAX_EXPORT_SYMBOLS}")
+            # Chunks the size of the drawn window, so the file opens with exactly the notes that were previewed
+            worker = workers.ExportMidiWorker(self.generator, self.settings.iterations, filename[0],
+                                              min(self.length, MAX_EXPORT_SYMBOLS), max(len(self.segment.notes), 1),
+                                              self.settings.prune, self.settings.quantize)
+            self.threadpool.start(worker)
+        else:
             self.segment.write_to_midi(export=True, filename=filename[0])
 
     def playing_complete(self):
@@ -215,7 +273,8 @@ class InstrumentSelector(QWidget):
         item = self.list_widget.currentItem().text()
 
         worker = workers.GenerateSegmentsWorker(
-            self.midi_extraction, self.filename, item, self.settings.order, self.settings.max_length)
+            self.midi_extraction, self.filename, item, self.settings.order, self.settings.max_length,
+            self.settings.backoff, self.settings.joint)
         self.threadpool.start(worker)
         worker.signals.finished.connect(self.generation_complete)
 
@@ -403,8 +462,9 @@ class Window(QWidget):
             self.threadpool.start(worker)
             worker.signals.finished.connect(self.playing_complete)
             self.now_playing = True
-        else:
-            print("Music already playing")
+        elif self.now_playing:
+            # Pressing play again stops the music
+            self.current_segment.stop()
 
     def playing_complete(self):
         self.now_playing = False
@@ -429,13 +489,17 @@ class Window(QWidget):
         if self.selected_segments:
             gen = helper.Generate(self.selected_segments, rules)
             gen.generate_rules()
-            melody = gen.rewriting_system(gen.axiom, 4)
-            notes, durations = gen.convert_to_segments(melody)
+            # Deep expansions grow exponentially, only a bounded window of them is rendered and drawn
+            length = gen.expansion_length(gen.axiom, self.settings.iterations)
+            if length > MAX_WINDOW_SYMBOLS:
+                print(f"Composition has {length} symbols, showing the first {MAX_WINDOW_SYMBOLS}")
+            notes, durations = gen.convert_window(gen.axiom, self.settings.iterations, 0,
+                                                  min(length, MAX_WINDOW_SYMBOLS))
 
             segment = helper.Segment(
                 notes, "test.mid", 0, durations, "", self.settings.prune, self.settings.quantize)
 
-            self.popup = GeneratorPopup(segment, self.threadpool)
+            self.popup = GeneratorPopup(segment, self.threadpool, gen, self.settings, length)
             self.popup.show()
 
 
@@ -0,0 +1,73 @@
+import argparse
+import os
+import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from database import Database
+from smf import write_midi
+
+# timidity output mode for each audio format
+OUTPUT_MODES = {"wav": "-Ow", "flac": "-OF"}
+
+# Seconds per quarter note at the 120 bpm tempo write_midi uses
+SECONDS_PER_QUARTER = 0.5
+
+
+def render(record, out_dir, audio_format, synth):
+    # Runs one synthesizer process, the midi file is piped in from memory
+    stem = os.path.splitext(record.filename)[0]
+    path = os.path.join(out_dir, f"{stem}_{record.index}.{audio_format}")
+    midi = write_midi(record.notes, record.durations)
+
+    start = time.perf_counter()
+    result = subprocess.run([synth, OUTPUT_MODES[audio_format], "-o", path, "-"], input=midi,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    elapsed = time.perf_counter() - start
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.decode(errors="replace").strip() or f"exit code {result.returncode}")
+
+    audio_seconds = float(sum(record.durations)) * SECONDS_PER_QUARTER
+    return path, elapsed, audio_seconds
+
+
+def render_batch(records, out_dir, audio_format, workers, synth):
+    os.makedirs(out_dir, exist_ok=True)
+    failed = 0
+    total_audio = 0.0
+    start = time.perf_counter()
+
+    # Every job waits on an external synthesizer process, so threads are enough to keep all cores busy
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(render, record, out_dir, audio_format, synth): record for record in records}
+        for count, future in enumerate(as_completed(futures), start=1):
+            record = futures[future]
+            try:
+                path, elapsed, audio_seconds = future.result()
+                total_audio += audio_seconds
+                print(f"[{count}/{len(records)}] {path}: {audio_seconds:.1f}s of audio in {elapsed:.2f}s "
+                      f"({audio_seconds / elapsed:.1f}x realtime)")
+            except Exception as e:
+                failed += 1
+                print(f"[{count}/{len(records)}] {record.filename} segment {record.index} failed: {e}")
+
+    elapsed = time.perf_counter() - start
+    print(f"Rendered {len(records) - failed}/{len(records)} segments, {total_audio:.1f}s of audio in {elapsed:.2f}s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Render stored segments to audio files")
+    parser.add_argument("--out-dir", default="out")
+    parser.add_argument("--format", choices=sorted(OUTPUT_MODES), default="wav")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--synth", default="timidity")
+    parser.add_argument("--filename")
+    parser.add_argument("--key")
+    parser.add_argument("--min-length", type=int)
+    parser.add_argument("--max-length", type=int)
+    parser.add_argument("--limit", type=int)
+    args = parser.parse_args()
+
+    segments = Database().fetch_segments(filename=args.filename, key=args.key, min_length=args.min_length,
+                                         max_length=args.max_length, limit=args.limit)
+    render_batch(segments, args.out_dir, args.format, args.workers, args.synth)
@@ -0,0 +1,144 @@
+import argparse
+import heapq
+import os
+import string
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from database import Database
+from lsystem import LSystem, cyclic_indices
+from smf import chord_pitches
+
+# Per process state, set once by init_worker so candidates only carry their rules
+_alphabet = None
+_iterations = None
+_metric = None
+_max_symbols = None
+_sizes = None
+_offsets = None
+_pitches = None
+_pitch_classes = None
+# Truncated expansions keyed by depth and the rules of every symbol that can appear before that depth
+_cache = {}
+CACHE_SIZE = 100000
+
+
+def smoothness(pitches, pitch_classes):
+    # Higher for melodies that move in small steps
+    pitches = pitches[~np.isnan(pitches)]
+    if pitches.size < 2:
+        return 0.0
+    return 1 / (1 + np.mean(np.abs(np.diff(pitches))))
+
+
+def entropy(pitches, pitch_classes):
+    # Normalised pitch class entropy, 1 when all twelve classes are used equally
+    histogram = pitch_classes.sum(axis=0)
+    if not histogram.sum():
+        return 0.0
+    p = histogram[histogram > 0] / histogram.sum()
+    return float(-(p * np.log(p)).sum() / np.log(12))
+
+
+METRICS = {"smoothness": smoothness, "entropy": entropy}
+
+
+def random_rules(alphabet, rng, max_rule_length=4):
+    rules = {}
+    for symbol in alphabet:
+        length = rng.integers(1, max_rule_length + 1)
+        rules[symbol] = "".join(rng.choice(list(alphabet), length))
+    return rules
+
+
+def init_worker(segments, iterations, metric, max_symbols):
+    global _alphabet, _iterations, _metric, _max_symbols, _sizes, _offsets, _pitches, _pitch_classes
+    _alphabet = list(segments)
+    _iterations = iterations
+    _metric = METRICS[metric]
+    _max_symbols = max_symbols
+
+    # Mean pitch and pitch classes of every note of every segment, back to back in alphabet order
+    notes = [token for symbol in _alphabet for token in segments[symbol]]
+    _sizes = np.array([len(segments[symbol]) for symbol in _alphabet], dtype=np.int64)
+    _offsets = np.cumsum(_sizes) - _sizes
+    _pitches = np.array([np.mean(chord_pitches(token)) if token != "rest" else np.nan for token in notes])
+    _pitch_classes = np.zeros((len(notes), 12))
+    for i, token in enumerate(notes):
+        for pitch in chord_pitches(token):
+            _pitch_classes[i, pitch % 12] += 1
+
+
+def expand(lsystem, rules):
+    # Expansions are cut to _max_symbols at every level, the expansion of a prefix is a prefix of the expansion
+    ids = lsystem.encode(_alphabet[0])
+    reachable = {_alphabet[0]}
+    for depth in range(1, _iterations + 1):
+        key = (depth, tuple(sorted((symbol, rules[symbol]) for symbol in reachable)))
+        if key in _cache:
+            ids = _cache[key]
+        else:
+            ids = lsystem.rewrite(ids)[:_max_symbols]
+            if len(_cache) >= CACHE_SIZE:
+                _cache.clear()
+            _cache[key] = ids
+        reachable |= {char for symbol in reachable for char in rules[symbol]}
+    return ids
+
+
+def evaluate(rules):
+    # Runs inside a worker process
+    lsystem = LSystem(rules, _alphabet)
+    ids = expand(lsystem, rules)
+    ids = ids[_sizes[ids] > 0]
+    if not ids.size:
+        return 0.0, rules
+    indices, _ = cyclic_indices(ids, np.zeros(len(_alphabet), dtype=np.int64), _sizes, _offsets)
+    # Scaled by the share of segments used, otherwise rules that never leave the axiom win
+    coverage = np.unique(ids).size / len(_alphabet)
+    return float(_metric(_pitches[indices], _pitch_classes[indices])) * coverage, rules
+
+
+def search_rules(segments, count=1000, k=10, iterations=4, metric="smoothness", workers=None, seed=None,
+                 max_symbols=4096, max_rule_length=4):
+    # segments maps each symbol to its note tokens, the first symbol is the axiom
+    rng = np.random.default_rng(seed)
+    candidates = {}
+    for _ in range(count):
+        rules = random_rules(list(segments), rng, max_rule_length)
+        candidates[tuple(rules.items())] = rules
+
+    # Sorted so candidates sharing the rules of the first symbols land in the same chunk and reuse its cache
+    candidates = [candidates[key] for key in sorted(candidates)]
+    workers = workers or os.cpu_count()
+    chunksize = max(1, len(candidates) // (workers * 4))
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                             initargs=(segments, iterations, metric, max_symbols)) as executor:
+        results = executor.map(evaluate, candidates, chunksize=chunksize)
+        return heapq.nlargest(k, results, key=lambda result: result[0])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Search for L-system rules over the stored segments of a file")
+    parser.add_argument("filename")
+    parser.add_argument("--segments", type=int, default=4)
+    parser.add_argument("--candidates", type=int, default=1000)
+    parser.add_argument("--top", type=int, default=10)
+    parser.add_argument("--iterations", type=int, default=4)
+    parser.add_argument("--metric", choices=sorted(METRICS), default="smoothness")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--seed", type=int)
+    args = parser.parse_args()
+
+    records = Database().fetch_segments(filename=args.filename, limit=min(args.segments, 26))
+    if not records:
+        print(f"No segments stored for {args.filename}")
+    else:
+        start = time.perf_counter()
+        segments = {symbol: record.notes for symbol, record in zip(string.ascii_lowercase, records)}
+        for score, rules in search_rules(segments, args.candidates, args.top, args.iterations, args.metric,
+                                         args.workers, args.seed):
+            print(f"{score:.4f} {rules}")
+        print(f"Scored {args.candidates} candidates in {time.perf_counter() - start:.2f}s")
@@ -0,0 +1,274 @@
+import io
+import struct
+from bisect import bisect_right
+from fractions import Fraction
+from functools import lru_cache
+from itertools import groupby
+
+import numpy as np
+
+# Pitch spelling music21 uses for MIDI note numbers
+PITCH_NAMES = ['C', 'C#', 'D', 'E-', 'E', 'F', 'F#', 'G', 'G#', 'A', 'B-', 'B']
+
+# Semitones above C for each step letter, and the alteration of each accidental symbol
+STEP_SEMITONES = {'C': 0, 'D': 2, 'E': 4, 'F': 5, 'G': 7, 'A': 9, 'B': 11}
+ACCIDENTALS = {'#': 1, '-': -1}
+
+# General MIDI program families, eight programs each
+INSTRUMENT_FAMILIES = ['Piano', 'Chromatic Percussion', 'Organ', 'Guitar', 'Bass', 'Strings', 'Ensemble', 'Brass',
+                       'Reed', 'Pipe', 'Synth Lead', 'Synth Pad', 'Synth Effects', 'Ethnic', 'Percussive',
+                       'Sound Effects']
+PERCUSSION_CHANNEL = 9
+
+# Krumhansl-Kessler key profiles, starting from the tonic
+MAJOR_PROFILE = np.array([6.35, 2.23, 3.48, 2.33, 4.38, 4.09, 2.52, 5.19, 2.39, 3.66, 2.29, 2.88])
+MINOR_PROFILE = np.array([6.33, 2.68, 3.52, 5.38, 2.60, 3.53, 2.54, 4.75, 3.98, 2.69, 3.34, 3.17])
+MAJOR_TONICS = ['C', 'C#', 'D', 'E-', 'E', 'F', 'F#', 'G', 'A-', 'A', 'B-', 'B']
+MINOR_TONICS = ['c', 'c#', 'd', 'e-', 'e', 'f', 'f#', 'g', 'g#', 'a', 'b-', 'b']
+
+
+def pitch_name(midi):
+    return f"{PITCH_NAMES[midi % 12]}{midi // 12 - 1}"
+
+
+@lru_cache(maxsize=None)
+def pitch_number(name):
+    # MIDI number of a music21 pitch name such as "C#4" or "B-3"
+    semitones = STEP_SEMITONES[name[0].upper()]
+    pos = 1
+    while pos < len(name) and name[pos] in ACCIDENTALS:
+        semitones += ACCIDENTALS[name[pos]]
+        pos += 1
+    return (int(name[pos:]) + 1) * 12 + semitones
+
+
+@lru_cache(maxsize=None)
+def chord_pitches(token):
+    # MIDI numbers of every pitch in a note or chord token, empty for rests
+    if token == 'rest':
+        return ()
+    return tuple(pitch_number(name) for name in token.split())
+
+
+def quantize(quarter_length):
+    # Snap to the nearest sixteenth or triplet eighth, like music21's default divisors
+    fours = Fraction(round(quarter_length * 4), 4)
+    threes = Fraction(round(quarter_length * 3), 3)
+    if abs(fours - quarter_length) <= abs(threes - quarter_length):
+        return fours
+    return threes
+
+
+def varlen(value):
+    # Variable length quantity, seven bits per byte with the high bit marking continuation
+    if value < 0:
+        raise ValueError(f"Variable length quantities cannot be negative, got {value}")
+    out = bytearray([value & 0x7F])
+    value >>= 7
+    while value:
+        out.insert(0, (value & 0x7F) | 0x80)
+        value >>= 7
+    return bytes(out)
+
+
+def write_midi(notes, durations, division=480, program=0, velocity=90, tempo=500000):
+    out = io.BytesIO()
+    writer = MidiWriter(out, division, program, velocity, tempo)
+    writer.write(notes, durations)
+    writer.close()
+    return out.getvalue()
+
+
+class MidiWriter:
+    # Single track standard midi file written chunk by chunk, the track length is patched in on close
+    def __init__(self, f, division=480, program=0, velocity=90, tempo=500000):
+        self.f = f
+        self.division = division
+        self.velocity = velocity
+        self.tick = 0
+        self.last = 0
+        self.start = f.tell()
+
+        f.write(b'MThd' + struct.pack('>IHHH', 6, 0, 1, division) + b'MTrk\x00\x00\x00\x00')
+        self.length = 0
+        self.__write(b'\x00\xff\x51\x03' + tempo.to_bytes(3, 'big') + b'\x00' + bytes([0xC0, program]))
+
+    def __write(self, data):
+        self.f.write(data)
+        self.length += len(data)
+
+    def write(self, notes, durations):
+        # Rests only move time forward
+        events = []
+        for token, duration in zip(notes, durations):
+            # Quantize can leave negative durations, time never moves backwards
+            length = max(0, round(float(duration) * self.division))
+            # A zero length note would have its note off sorted before its note on and hang
+            for pitch in chord_pitches(token) if length else ():
+                events.append((self.tick, 1, bytes([0x90, pitch, self.velocity])))
+                # Note offs sort before note ons on the same tick so repeated notes are not cut short
+                events.append((self.tick + length, 0, bytes([0x80, pitch, 0])))
+            self.tick += length
+        events.sort(key=lambda event: (event[0], event[1]))
+
+        # Notes never outlast their own duration, so every event of the chunk can be written now
+        track = bytearray()
+        for tick, _, message in events:
+            track += varlen(tick - self.last) + message
+            self.last = tick
+        self.__write(bytes(track))
+
+    def close(self):
+        self.__write(b'\x00\xff\x2f\x00')
+        end = self.f.tell()
+        self.f.seek(self.start + 18)
+        self.f.write(struct.pack('>I', self.length))
+        self.f.seek(end)
+
+
+class MidiReader:
+    def __init__(self, filename):
+        with open(filename, 'rb') as f:
+            self.data = f.read()
+        self.division = None
+        # (onset tick, end tick, pitch, instrument name) for every note in the file
+        self.notes = []
+        self.__read()
+
+    def __read(self):
+        if self.data[:4] != b'MThd':
+            raise ValueError("Not a standard midi file")
+        length, _, tracks, division = struct.unpack('>IHHH', self.data[4:14])
+        if division & 0x8000:
+            raise ValueError("SMPTE time division is not supported")
+        self.division = division
+
+        # Program changes per channel across every track, format 1 files often keep them apart from the notes
+        self._programs = {}
+        # (onset tick, end tick, pitch, channel) until the programs of all tracks are known
+        notes = []
+        pos = 8 + length
+        for _ in range(tracks):
+            if self.data[pos:pos + 4] != b'MTrk':
+                break
+            (length,) = struct.unpack('>I', self.data[pos + 4:pos + 8])
+            notes += self.__read_track(pos + 8, pos + 8 + length)
+            pos += 8 + length
+
+        timelines = {}
+        for channel, changes in self._programs.items():
+            changes.sort(key=lambda change: change[0])
+            timelines[channel] = ([tick for tick, _ in changes], [program for _, program in changes])
+        for onset, end, pitch, channel in notes:
+            ticks, programs = timelines.get(channel, ((), ()))
+            i = bisect_right(ticks, onset)
+            program = programs[i - 1] if i else 0
+            self.notes.append((onset, end, pitch, self.__instrument(channel, program)))
+        self.notes.sort()
+
+    def __read_varlen(self, pos):
+        value = 0
+        while True:
+            byte = self.data[pos]
+            pos += 1
+            value = (value << 7) | (byte & 0x7F)
+            if not byte & 0x80:
+                return value, pos
+
+    def __read_track(self, pos, end):
+        data = self.data
+        tick = 0
+        status = 0
+        notes = []
+        # Onsets of sounding notes keyed by (channel, pitch)
+        sounding = {}
+
+        while pos < end:
+            delta, pos = self.__read_varlen(pos)
+            tick += delta
+
+            if data[pos] & 0x80:
+                status = data[pos]
+                pos += 1
+
+            if status == 0xFF:
+                # Meta event
+                pos += 1
+                length, pos = self.__read_varlen(pos)
+                pos += length
+                status = 0
+                continue
+            if status in (0xF0, 0xF7):
+                # System exclusive
+                length, pos = self.__read_varlen(pos)
+                pos += length
+                status = 0
+                continue
+
+            kind = status & 0xF0
+            channel = status & 0x0F
+            if kind in (0xC0, 0xD0):
+                if kind == 0xC0:
+                    self._programs.setdefault(channel, []).append((tick, data[pos]))
+                pos += 1
+                continue
+
+            pitch, velocity = data[pos], data[pos + 1]
+            pos += 2
+            if kind == 0x90 and velocity > 0:
+                sounding.setdefault((channel, pitch), []).append(tick)
+            elif kind == 0x80 or kind == 0x90:
+                onsets = sounding.get((channel, pitch))
+                if onsets:
+                    notes.append((onsets.pop(0), tick, pitch, channel))
+        return notes
+
+    @staticmethod
+    def __instrument(channel, program):
+        if channel == PERCUSSION_CHANNEL:
+            return 'Percussion'
+        return INSTRUMENT_FAMILIES[program // 8]
+
+    def get_instruments(self):
+        return list(dict.fromkeys(name for _, _, _, name in self.notes))
+
+    def get_tokens(self, inst):
+        notes = []
+        durations = []
+        for token, duration in self.iter_tokens(inst):
+            notes.append(token)
+            durations.append(duration)
+        return notes, durations
+
+    def iter_tokens(self, inst):
+        # Yield (note, duration) tokens one chord at a time, notes of the instrument that start together form a chord
+        cursor = 0
+        selected = (note for note in self.notes if note[3] == inst)
+        for onset, chord in groupby(selected, key=lambda note: note[0]):
+            chord = list(chord)
+            start = quantize(onset / self.division)
+            if start > cursor:
+                yield 'rest', float(start - cursor)
+
+            duration = quantize(max(end for _, end, _, _ in chord) / self.division) - start
+            if duration <= 0:
+                duration = Fraction(1, 4)
+            yield ' '.join(pitch_name(pitch) for _, _, pitch, _ in chord), float(duration)
+            cursor = max(cursor, start + duration)
+
+    def get_key(self):
+        # Krumhansl-Schmuckler key finding on a duration weighted pitch class histogram
+        histogram = np.zeros(12)
+        for onset, end, pitch, name in self.notes:
+            if name != 'Percussion':
+                histogram[pitch % 12] += end - onset
+
+        best, best_score = None, -np.inf
+        for tonic in range(12):
+            rotated = np.roll(histogram, -tonic)
+            for profile, names in ((MAJOR_PROFILE, MAJOR_TONICS), (MINOR_PROFILE, MINOR_TONICS)):
+                score = np.corrcoef(rotated, profile)[0, 1]
+                if score > best_score:
+                    mode = 'major' if names is MAJOR_TONICS else 'minor'
+                    best, best_score = f"{names[tonic]} {mode}", score
+        return best
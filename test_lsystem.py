@@ -0,0 +1,95 @@
+from collections import Counter
+
+import numpy as np
+import pytest
+
+from lsystem import LSystem, cyclic_indices
+
+RULES = [
+    {'a': 'ab', 'b': 'a'},
+    {'a': 'abc', 'b': 'ca', 'c': ''},
+    {'a': 'b', 'b': 'cc', 'c': 'ad'},
+]
+
+
+def naive_expand(rules, axiom, n):
+    for _ in range(n):
+        axiom = "".join(rules.get(char, char) for char in axiom)
+    return axiom
+
+
+def as_counter(lsystem, counts):
+    return Counter({symbol: int(count) for symbol, count in zip(lsystem.symbols, counts) if count})
+
+
+@pytest.mark.parametrize('rules', RULES)
+def test_expand_matches_string_rewriting(rules):
+    lsystem = LSystem(rules)
+    for n in range(7):
+        expected = naive_expand(rules, 'ab', n)
+        assert lsystem.decode(lsystem.expand(lsystem.encode('ab'), n)) == expected
+
+        chunks = list(lsystem.iter_expand(lsystem.encode('ab'), n, chunk_size=3))
+        assert all(chunk.size <= 3 for chunk in chunks)
+        assert "".join(lsystem.decode(chunk) for chunk in chunks) == expected
+
+
+@pytest.mark.parametrize('rules', RULES)
+def test_counts_and_lengths(rules):
+    # d has no rule and rewrites to itself
+    lsystem = LSystem(rules, 'abd')
+    ids = lsystem.encode('abd')
+    for n in range(7):
+        expected = naive_expand(rules, 'abd', n)
+        assert lsystem.length(ids, n) == len(expected)
+        assert as_counter(lsystem, lsystem.counts(n)[ids].sum(axis=0)) == Counter(expected)
+
+
+def test_deep_lengths_do_not_overflow():
+    # Fibonacci words, the expansion at depth n has fib(n + 2) symbols
+    lsystem = LSystem({'a': 'ab', 'b': 'a'})
+    fib = [0, 1]
+    while len(fib) < 203:
+        fib.append(fib[-1] + fib[-2])
+    assert lsystem.length(lsystem.encode('a'), 200) == fib[202]
+
+
+@pytest.mark.parametrize('rules', RULES)
+def test_prefix_counts(rules):
+    lsystem = LSystem(rules)
+    ids = lsystem.encode('ba')
+    expected = naive_expand(rules, 'ba', 6)
+    for stop in range(len(expected) + 2):
+        assert as_counter(lsystem, lsystem.prefix_counts(ids, 6, stop)) == Counter(expected[:stop])
+
+
+@pytest.mark.parametrize('rules', RULES)
+def test_range_matches_string_slices(rules):
+    lsystem = LSystem(rules)
+    ids = lsystem.encode('ab')
+    expected = naive_expand(rules, 'ab', 6)
+    for start in range(len(expected) + 1):
+        for stop in range(start, len(expected) + 2):
+            assert lsystem.decode(lsystem.symbols_range(ids, 6, start, stop)) == expected[start:stop]
+
+    chunks = list(lsystem.iter_range(ids, 6, 3, len(expected) - 2, chunk_size=2))
+    assert "".join(lsystem.decode(chunk) for chunk in chunks) == expected[3:-2]
+
+
+def test_cyclic_indices():
+    rng = np.random.default_rng(0)
+    sizes = np.array([3, 1, 5, 2])
+    offsets = np.cumsum(sizes) - sizes
+    for _ in range(50):
+        ids = rng.integers(0, len(sizes), size=rng.integers(1, 20))
+        states = rng.integers(0, sizes)
+
+        # Every occurrence of a symbol takes the next step items of its cycle
+        expected, cycle = [], states.copy()
+        for i in ids:
+            expected += [offsets[i] + (cycle[i] + j) % sizes[i] for j in range(4)]
+            cycle[i] = (cycle[i] + 4) % sizes[i]
+
+        indices, new_states = cyclic_indices(ids, states, sizes, offsets)
+        assert indices.tolist() == expected
+        assert new_states.tolist() == cycle.tolist()
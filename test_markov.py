@@ -0,0 +1,135 @@
+from collections import Counter, defaultdict
+
+import numpy as np
+import pytest
+
+from markov import Markov, MarkovModel, NgramCounter
+
+TOKENS = ['C4', 'D4', 'C4', 'E4', 'rest', 'C4', 'D4', 'C4', 'D4', 'E4', 'G4', 'C4', 'rest', 'E4', 'C4', 'D4']
+
+
+def naive_ngrams(streams, order):
+    # Every position of every stream with the order tokens before it, None before the stream starts
+    counts = Counter()
+    for tokens in streams:
+        padded = [None] * order + list(tokens)
+        for i in range(order, len(padded)):
+            counts[tuple(padded[i - order:i + 1])] += 1
+    return counts
+
+
+def counter_ngrams(counter):
+    counts = Counter()
+    for row, weight in zip(counter.ngrams, counter.weights):
+        counts[tuple(counter.states[i] if i >= 0 else None for i in row)] += int(weight)
+    return counts
+
+
+def transitions(model):
+    # Successor counts of every context, contexts as token tuples without the padding
+    table = {}
+    for c in range(len(model)):
+        context = tuple(model.states[i] for i in model.contexts[c] if i >= 0)
+        start, end = model.indptr[c], model.indptr[c + 1]
+        table[context] = {model.states[i]: int(n) for i, n in zip(model.indices[start:end], model.counts[start:end])}
+    return table
+
+
+def context_of(model, c):
+    return tuple(model.states[i] for i in model.contexts[c] if i >= 0)
+
+
+@pytest.mark.parametrize('order', [1, 2, 3])
+def test_counter_matches_naive_counts(order):
+    streams = [TOKENS, TOKENS[3:11], ['C4']]
+    counter = NgramCounter(order)
+    for tokens in streams:
+        counter.update(tokens, chunk_size=3)
+
+    assert counter_ngrams(counter) == naive_ngrams(streams, order)
+
+
+def test_fed_chunks_and_merged_counters_match_naive_counts():
+    fed = NgramCounter(2)
+    for i in range(0, len(TOKENS), 5):
+        fed.feed(TOKENS[i:i + 5])
+    assert counter_ngrams(fed) == naive_ngrams([TOKENS], 2)
+
+    merged = NgramCounter(2).update(TOKENS[:7]).merge(NgramCounter(2).update(TOKENS[7:]))
+    assert counter_ngrams(merged) == naive_ngrams([TOKENS[:7], TOKENS[7:]], 2)
+
+
+@pytest.mark.parametrize('order', [1, 2])
+def test_fixed_order_transitions(order):
+    model = Markov(order).from_counter(NgramCounter(order).update(TOKENS))
+
+    expected = defaultdict(Counter)
+    for i in range(order, len(TOKENS)):
+        expected[tuple(TOKENS[i - order:i])][TOKENS[i]] += 1
+    assert transitions(model) == {context: dict(nexts) for context, nexts in expected.items()}
+    assert context_of(model, model.start) == tuple(TOKENS[:order])
+
+    # Taking a successor moves to the context ending in it, -1 when that context never occurs
+    for c in range(len(model)):
+        for k in range(model.indptr[c], model.indptr[c + 1]):
+            reached = context_of(model, c)[1:] + (model.states[model.indices[k]],)
+            if reached in expected:
+                assert context_of(model, model.next_context[k]) == reached
+            else:
+                assert model.next_context[k] == -1
+
+
+@pytest.mark.parametrize('order', [1, 2, 3])
+def test_backoff_transitions(order):
+    model = Markov(order, backoff=True).from_counter(NgramCounter(order).update(TOKENS))
+
+    # Every context up to order tokens long, from the positions that have that many tokens before them
+    expected = defaultdict(Counter)
+    for i in range(len(TOKENS)):
+        for length in range(min(i, order) + 1):
+            expected[tuple(TOKENS[i - length:i])][TOKENS[i]] += 1
+    assert transitions(model) == {context: dict(nexts) for context, nexts in expected.items()}
+    assert [len(context_of(model, c)) for c in model.starts] == [order] * len(model.starts)
+
+    # Taking a successor moves to the longest known suffix of the context followed by it
+    for c in range(len(model)):
+        for k in range(model.indptr[c], model.indptr[c + 1]):
+            history = context_of(model, c) + (model.states[model.indices[k]],)
+            suffix = next(history[i:] for i in range(len(history)) if len(history) - i <= order
+                          and history[i:] in expected)
+            assert context_of(model, model.next_context[k]) == suffix
+
+
+@pytest.mark.parametrize('backoff', [False, True])
+def test_alias_tables_match_counts(backoff):
+    model = Markov(2, backoff).from_counter(NgramCounter(2).update(TOKENS))
+    sampler = model.sampler
+
+    for c in range(len(model)):
+        start, end = model.indptr[c], model.indptr[c + 1]
+        # Each column keeps its own share and passes the rest to its alias
+        p = sampler.prob[start:end].copy()
+        np.add.at(p, sampler.alias[start:end] - start, 1 - sampler.prob[start:end])
+        counts = model.counts[start:end]
+        assert p / (end - start) == pytest.approx(counts / counts.sum())
+
+
+def test_draws_follow_counts():
+    model = Markov(1).from_counter(NgramCounter(1).update(TOKENS))
+    c = next(c for c in range(len(model)) if context_of(model, c) == ('C4',))
+    start, end = model.indptr[c], model.indptr[c + 1]
+
+    draws = model.sampler.draw(np.full(100000, c), np.random.default_rng(0))
+    frequencies = np.bincount(draws - start, minlength=end - start) / len(draws)
+    counts = model.counts[start:end]
+    assert frequencies == pytest.approx(counts / counts.sum(), abs=0.01)
+
+
+@pytest.mark.parametrize('backoff', [False, True])
+def test_generated_transitions_were_seen(backoff):
+    markov_chain = Markov(2, backoff)
+    model = MarkovModel.loads(markov_chain.from_counter(NgramCounter(2).update(TOKENS * 2)).dumps())
+    seen = set(zip(TOKENS, TOKENS[1:], TOKENS[2:])) | set(zip(TOKENS[-2:], TOKENS[:2], TOKENS[1:3]))
+
+    for sequence in markov_chain.generate_batch(model, [5, 40, 17], np.random.default_rng(1)):
+        assert set(zip(sequence, sequence[1:], sequence[2:])) <= seen
@@ -0,0 +1,72 @@
+import io
+import struct
+
+import pytest
+
+from smf import MidiReader, MidiWriter, varlen, write_midi
+
+
+def read_back(data, tmp_path):
+    path = tmp_path / "out.mid"
+    path.write_bytes(data)
+    return MidiReader(str(path))
+
+
+def test_round_trip(tmp_path):
+    notes = ['C4', 'E-4 G4', 'rest', 'B3', 'B3', 'C#5', 'D4']
+    durations = [1.0, 0.5, 0.5, 1 / 3, 1 / 3, 1 / 3, 4.0]
+
+    reader = read_back(write_midi(notes, durations), tmp_path)
+
+    assert reader.get_instruments() == ['Piano']
+    read_notes, read_durations = reader.get_tokens('Piano')
+    assert read_notes == notes
+    assert read_durations == pytest.approx(durations)
+
+
+def test_chunked_writer_matches_write_midi():
+    notes = ['C4', 'D4', 'rest', 'E4 G4', 'F4']
+    durations = [0.5, 1.0, 0.25, 2.0, 0.75]
+
+    out = io.BytesIO()
+    writer = MidiWriter(out)
+    writer.write(notes[:2], durations[:2])
+    writer.write(notes[2:], durations[2:])
+    writer.close()
+
+    assert out.getvalue() == write_midi(notes, durations)
+
+
+def test_negative_and_zero_durations_leave_no_stuck_notes(tmp_path):
+    # Notes that do not last are left out instead of writing a note off before its note on
+    assert write_midi(['C4', 'D4', 'E4', 'F4'], [6.0, -2.0, 0.0, 1.0]) == write_midi(['C4', 'F4'], [6.0, 1.0])
+
+    out = io.BytesIO()
+    writer = MidiWriter(out)
+    writer.write(['C4', 'D4'], [6.0, -2.0])
+    writer.write(['E4', 'F4'], [0.0, 1.0])
+    writer.close()
+
+    reader = read_back(out.getvalue(), tmp_path)
+    assert [(onset, end, pitch) for onset, end, pitch, _ in sorted(reader.notes)] == [(0, 2880, 60), (2880, 3360, 65)]
+
+
+def test_program_change_in_another_track(tmp_path):
+    # Format 1 file whose first track sets channel 3 to a trumpet and whose second track plays on it
+    tracks = [b'\x00\xc2\x38\x00\xff\x2f\x00',
+              b'\x00\x92\x3c\x50\x83\x60\x82\x3c\x00\x00\xff\x2f\x00']
+    data = b'MThd' + struct.pack('>IHHH', 6, 1, len(tracks), 480)
+    data += b''.join(b'MTrk' + struct.pack('>I', len(track)) + track for track in tracks)
+
+    reader = read_back(data, tmp_path)
+
+    assert reader.notes == [(0, 480, 60, 'Brass')]
+
+
+def test_varlen():
+    assert varlen(0) == b'\x00'
+    assert varlen(0x7F) == b'\x7f'
+    assert varlen(0x80) == b'\x81\x00'
+    assert varlen(0x0FFFFFFF) == b'\xff\xff\xff\x7f'
+    with pytest.raises(ValueError):
+        varlen(-1)
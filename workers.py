@@ -1,6 +1,5 @@
 import sys
 import traceback
-from random import randint
 
 from PyQt5.QtCore import QRunnable, pyqtSlot, QObject, pyqtSignal
 
@@ -27,14 +26,14 @@ class ProcessMidiWorker(QRunnable):
     def run(self):
         try:
             # Extract the notes from midi file using midi helper
-            self.midi_extraction = helper.ExtractMidi(f"midi/{self.filename}")
+            self.midi_extraction = helper.ExtractMidi(f"midi/{self.filename}", Database())
         finally:
             if self.midi_extraction is not None:
                 self.signals.result.emit(self.midi_extraction)
 
 
 class GenerateSegmentsWorker(QRunnable):
-    def __init__(self, item, filename, instrument, markov_depth, max_length):
+    def __init__(self, item, filename, instrument, markov_depth, max_length, backoff=True, joint=False):
         super().__init__()
         self.signals = WorkerSignals()
         self.filename = filename
@@ -42,6 +41,8 @@ class GenerateSegmentsWorker(QRunnable):
         self.item = item
         self.order = markov_depth
         self.max_length = max_length
+        self.backoff = backoff
+        self.joint = joint
 
     @pyqtSlot()
     def run(self):
@@ -49,39 +50,15 @@ class GenerateSegmentsWorker(QRunnable):
             database = Database()
             # Extract the notes from midi file using midi helper
             midi_extraction = self.item
-            midi_extraction.parse_midi(inst=self.instrument)
-            notes = midi_extraction.get_notes()
             key = midi_extraction.get_key()
 
-            # Generate markov chain
-            markov_chain = Markov(self.order)
-            markov_notes = markov_chain.transition_matrix(notes)
-            float_durations = [float(a)
-                               for a in midi_extraction.get_durations()]
-            durations_as_str = [str(a) for a in float_durations]
-            durations_markov = markov_chain.transition_matrix(durations_as_str)
-
-            # Generate 15 sequence of notes using the markov chain
-            sequences_notes = []
-            sequence_durations = []
-            for _ in range(15):
-                success = False
-                while not success:
-                    try:
-                        # Generate a segment of length some power 2^n
-                        length = 2 ** randint(2, self.max_length)
-                        notes = markov_chain.generate_sequence(
-                            markov_notes, length=length)
-                        durations = markov_chain.generate_sequence(
-                            durations_markov, length=length)
-                        sequence_durations.append(durations)
-                        sequences_notes.append(notes)
-                        success = True
-                    except Exception as e:
-                        print(e)
-
-            database.insert_or_update(self.filename, database.to_json(sequences_notes), database.to_json(sequence_durations),
-                                      str(key))
+            # Generate 15 sequence of notes using the stored or freshly fitted markov chains
+            markov_chain = Markov(self.order, self.backoff, self.joint)
+            models = markov_chain.load_or_fit(database, self.filename, self.instrument, midi_extraction)
+            sequences_notes, sequence_durations = markov_chain.generate_segments(models, self.max_length)
+
+            database.insert_segments(self.filename, sequences_notes, sequence_durations, str(key), self.instrument,
+                                     self.order)
         except Exception as e:
             print(e)
             traceback.print_exc()
@@ -109,6 +86,31 @@ class PlayMidiWorker(QRunnable):
             self.signals.finished.emit("")
 
 
+class ExportMidiWorker(QRunnable):
+    def __init__(self, generator: helper.Generate, iterations, filename, stop, chunk_size, do_prune, do_quantize):
+        super().__init__()
+        self.generator = generator
+        self.iterations = iterations
+        self.filename = filename
+        self.stop = stop
+        self.chunk_size = chunk_size
+        self.do_prune = do_prune
+        self.do_quantize = do_quantize
+        self.signals = WorkerSignals()
+
+    @pyqtSlot()
+    def run(self) -> None:
+        try:
+            self.generator.export_midi(self.generator.axiom, self.iterations, self.filename, self.chunk_size, self.stop,
+                                       self.do_prune, self.do_quantize)
+        except:
+            traceback.print_exc()
+            exctype, value = sys.exc_info()[:2]
+            self.signals.error.emit((exctype, value, traceback.format_exc()))
+        finally:
+            self.signals.finished.emit(self.filename)
+
+
 class FetchDataWorker(QRunnable):
     def __init__(self, filename, do_prune, quantize):
         QRunnable.__init__(self)
@@ -122,17 +124,12 @@ class FetchDataWorker(QRunnable):
         current_segments = None
         try:
             database = Database()
-            json_sequence = database.get_sequence(self.filename)
-            json_durations = database.get_durations(self.filename)
-            key = database.get_key(self.filename)
+            sequences, durations, key = database.get_segments(self.filename)
 
             current_segments = []
-            sequences = database.to_lst(json_sequence)
-            durations = database.to_lst(json_durations)
             for i in range(len(sequences)):
-                duration = [float(a) for a in durations[i]]
                 current_segments.append(helper.Segment(
-                    sequences[i], self.filename, i, duration, key, self.do_prune, self.do_quantize))
+                    sequences[i], self.filename, i, durations[i].tolist(), key, self.do_prune, self.do_quantize))
         except:
             traceback.print_exc()
             exctype, value = sys.exc_info()[:2]